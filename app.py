@@ -1,6 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, make_response, send_from_directory
-import json, os, datetime, re, io
-import werkzeug
+from flask import Flask, render_template, request, redirect, url_for, make_response, send_from_directory, jsonify, stream_with_context
+from flask import g, abort, has_request_context, before_render_template, template_rendered
+import json, os, sys, datetime, re, io, sqlite3, threading, weakref, csv, zlib, gzip, hashlib, itertools, tarfile, tempfile, time, bisect, math
+import cProfile, hmac, functools, multiprocessing, mmap, struct, array, unicodedata, pickle, atexit, heapq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from urllib.parse import urlencode
+import click
+try:
+    import fcntl
+except ImportError:  # Windows: solo lock in-process
+    fcntl = None
+try:
+    import numpy as np
+except ImportError:  # senza numpy niente analisi dei trend
+    np = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # senza Pillow la galleria usa gli originali
+    Image = ImageOps = None
+from markupsafe import Markup
 
 app = Flask(__name__)
 
@@ -8,6 +27,33 @@ app = Flask(__name__)
 DATA_ROOT = os.environ.get("DATA_ROOT", ".")
 USERS_DIR = os.path.join(DATA_ROOT, "users")
 os.makedirs(USERS_DIR, exist_ok=True)
+REGISTRY_PATH = os.path.join(USERS_DIR, "registry.sqlite3")  # elenco utenti con data e dimensione dell'ultimo salvataggio
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")  # "json" | "sqlite"
+SQLITE_PATH = os.environ.get("SQLITE_PATH") or os.path.join(DATA_ROOT, "fitness.sqlite3")
+DOC_CACHE_BYTES = int(os.environ.get("DOC_CACHE_BYTES", 64 * 1024 * 1024))  # memoria stimata dei documenti in cache; 0 = disattivata
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", 16 * 1024 * 1024))  # 0 = disattivata
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"  # /metrics + tempi per fase
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")  # Bearer per /metrics; senza token solo da localhost
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"      # header Server-Timing nelle risposte
+# Profiler su richiesta: ?_profile=<PROFILE_TOKEN> oppure header X-Profile (senza PROFILE_TOKEN resta spento)
+FOODS_CSV = os.environ.get("FOODS_CSV") or os.path.join(DATA_ROOT, "foods.csv")          # catalogo alimenti (per 100 g)
+FOODS_INDEX = os.environ.get("FOODS_INDEX") or os.path.join(DATA_ROOT, "foods.idx")    # indice precompilato, in mmap
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0") == "1"
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_DIR = os.path.join(DATA_ROOT, "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 200))
+PROFILE_SAMPLE_MS = float(os.environ.get("PROFILE_SAMPLE_MS", 2))
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", 480))        # lato massimo delle anteprime (px)
+THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", 2))    # thread che generano le anteprime
+COLD_AFTER_DAYS = int(os.environ.get("COLD_AFTER_DAYS", 183))           # tier-data: mesi più vecchi -> segmenti freddi
+COLD_CACHE_BYTES = int(os.environ.get("COLD_CACHE_BYTES", 32 * 1024 * 1024))  # memoria stimata dei segmenti freddi letti; 0 = niente cache
+# Write-behind (solo backend JSON): i salvataggi restano in memoria e un thread li scrive
+# al più tardi dopo FLUSH_INTERVAL secondi = dati che si possono perdere in caso di crash.
+# Solo con un processo: gli altri worker vedrebbero i dati vecchi fino al flush, quindi
+# gunicorn.conf.py avvia 1 worker (le --threads restano) quando WRITE_BEHIND=1.
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 2.0))
+FLUSH_MAX_DIRTY = int(os.environ.get("FLUSH_MAX_DIRTY", 64))  # oltre questi utenti in attesa si scrive subito
 
 ALLOWED_IMG = {"png", "jpg", "jpeg", "webp"}
 TRAINING_DAYS = {"Monday", "Tuesday", "Thursday", "Friday"}  # Lun, Mar, Gio, Ven
@@ -20,41 +66,1320 @@ def get_current_user():
     uid = request.args.get("u") or request.cookies.get("u") or "default"
     return sanitize_user_id(uid)
 
-def user_dirs(user_id):
-    base = os.path.join(USERS_DIR, user_id)
+def sharded_base(user_id):
+    h = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+    return os.path.join(USERS_DIR, h[:2], h[2:4], user_id)
+
+def is_legacy_user_dir(path):
+    return any(os.path.exists(os.path.join(path, name)) for name in ("data.json", "uploads", "version"))
+
+def user_base(user_id):
+    """Cartella dell'utente: users/<ab>/<cd>/<uid> (dall'hash dell'id); users/<uid> se non ancora migrata."""
+    base = sharded_base(user_id)
+    if not os.path.isdir(base):
+        legacy = os.path.join(USERS_DIR, user_id)
+        if is_legacy_user_dir(legacy):
+            return legacy
+    return base
+
+def user_dirs(user_id, create=False):
+    """(data.json, cartella uploads); le cartelle si creano solo quando si scrive (create=True)."""
+    base = user_base(user_id)
     data_path = os.path.join(base, "data.json")
     up_dir = os.path.join(base, "uploads")
-    os.makedirs(base, exist_ok=True)
-    os.makedirs(up_dir, exist_ok=True)
+    if create:
+        os.makedirs(up_dir, exist_ok=True)
     return data_path, up_dir
 
+def default_data():
+    return {
+        "giornaliero": [],
+        "allenamenti": [],
+        "alimentazione": [],
+        "meal_plan": {
+            "Monday":"training","Tuesday":"training","Wednesday":"rest",
+            "Thursday":"training","Friday":"training","Saturday":"rest","Sunday":"rest"
+        },
+        "goals": {
+            "kcal_training":1700,"kcal_rest":1500,
+            "weight_start":61.0,"weight_target":55.0,"peso_attuale":None
+        }
+    }
+
 def load_data(user_id=None):
     uid = user_id or get_current_user()
-    data_path, _ = user_dirs(uid)
-    if not os.path.exists(data_path):
-        data = {
-            "giornaliero": [],
-            "allenamenti": [],
-            "alimentazione": [],
-            "meal_plan": {
-                "Monday":"training","Tuesday":"training","Wednesday":"rest",
-                "Thursday":"training","Friday":"training","Saturday":"rest","Sunday":"rest"
-            },
-            "goals": {
-                "kcal_training":1700,"kcal_rest":1500,
-                "weight_start":61.0,"weight_target":55.0,"peso_attuale":None
-            }
-        }
+    data = STORE.read(uid)
+    if data is None:
+        data = default_data()
         save_data(data, uid)
-        return data
-    with open(data_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return data
 
 def save_data(data, user_id=None):
     uid = user_id or get_current_user()
-    data_path, _ = user_dirs(uid)
-    with open(data_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    STORE.write(uid, data)
+
+def transaction(user_id=None, write=True):
+    """Unità di lavoro su un utente: legge/scrive solo le righe che servono alla route."""
+    uid = user_id or get_current_user()
+    return STORE.transaction(uid, write)
+
+# ===================== STORAGE =====================
+COLLECTIONS = ("giornaliero", "allenamenti", "alimentazione")
+SECTIONS = ("meal_plan", "goals")
+
+def first_float(rows, field):
+    for r in rows:
+        if r.get(field):
+            try: return float(r.get(field))
+            except: continue
+    return None
+
+class UserLock:
+    """Lock esclusivo per utente: RLock tra i thread + flock su users/<uid>/.lock tra i worker."""
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fh = None
+
+    def acquire(self):
+        self.rlock.acquire()
+        self.depth += 1
+        if self.depth > 1 or fcntl is None or self.uid in _held_flocks:
+            return
+        try:
+            base = user_base(self.uid)
+            os.makedirs(base, exist_ok=True)
+            self.fh = open(os.path.join(base, ".lock"), "a")
+            fcntl.flock(self.fh, fcntl.LOCK_EX)
+        except BaseException:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+            self.depth -= 1
+            self.rlock.release()
+            raise
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.fh is not None:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+            self.fh.close()
+            self.fh = None
+        self.rlock.release()
+
+    def keep_file_lock(self):
+        """Il flock resta al processo anche dopo il release, finché non lo libera release_file_lock."""
+        if self.fh is not None:
+            _held_flocks[self.uid] = self.fh
+            self.fh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+_user_locks = weakref.WeakValueDictionary()
+_user_locks_guard = threading.Lock()
+_held_flocks = {}  # uid -> file con il flock tenuto dal write-behind (modifiche non ancora su disco)
+
+def release_file_lock(uid):
+    # da chiamare sotto user_lock(uid)
+    fh = _held_flocks.pop(uid, None)
+    if fh is not None:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+def user_lock(uid):
+    with _user_locks_guard:
+        lock = _user_locks.get(uid)
+        if lock is None:
+            lock = _user_locks[uid] = UserLock(uid)
+        return lock
+
+def file_stamp(st):
+    # mtime + size + inode: cambia a ogni riscrittura, anche se fatta da un altro worker
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class UserRegistry:
+    """Registro degli utenti del backend JSON (SQLite): uid, byte e mtime dell'ultimo data.json scritto.
+
+    I job batch e le viste di amministrazione elencano e ordinano gli utenti da qui, senza
+    percorrere l'albero users/. Il primo uso lo riempie con una scansione completa (segnata in
+    meta), perché persist() aggiunge solo gli utenti salvati dopo; migrate-layout lo ricostruisce.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, bytes INTEGER NOT NULL, mtime REAL NOT NULL)",
+              "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    ORDER = {"uid": "uid", "recent": "mtime DESC", "size": "bytes DESC"}
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            for sql in self.SCHEMA:
+                c.execute(sql)
+            self._local.conn = c
+        return c
+
+    def touch(self, uid, size, mtime):
+        self.conn().execute("INSERT OR REPLACE INTO users (uid, bytes, mtime) VALUES (?, ?, ?)", (uid, size, mtime))
+
+    def count(self):
+        return self.conn().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def scanned(self):
+        return self.conn().execute("SELECT 1 FROM meta WHERE key = 'scanned'").fetchone() is not None
+
+    def user_ids(self):
+        return [uid for (uid,) in self.conn().execute("SELECT uid FROM users ORDER BY uid")]
+
+    def rows(self, order="uid", limit=None):
+        sql = f"SELECT uid, bytes, mtime FROM users ORDER BY {self.ORDER[order]}"
+        return self.conn().execute(sql + (" LIMIT ?" if limit else ""), (limit,) if limit else ()).fetchall()
+
+    def replace(self, entries, since):
+        """Sostituisce il registro con una scansione iniziata a `since`, senza perdere i salvataggi nel frattempo."""
+        c = self.conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("DELETE FROM users WHERE mtime < ?", (since,))
+            c.executemany("INSERT INTO users (uid, bytes, mtime) VALUES (?, ?, ?) ON CONFLICT (uid) DO UPDATE"
+                          " SET bytes = excluded.bytes, mtime = excluded.mtime WHERE excluded.mtime >= users.mtime",
+                          entries)
+            c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scanned', ?)", (str(since),))
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+
+REGISTRY = UserRegistry(REGISTRY_PATH)
+
+# Memoria occupata in Python rispetto ai byte su disco (misurata con tracemalloc su gendata)
+DOC_PARSED_FACTOR = 2.0        # data.json indentato -> dict/list/str
+COMPACT_PARSED_FACTOR = 11.0   # JSON compatto fatto quasi solo di numeri (indice esercizi)
+SEGMENT_PARSED_FACTOR = 4.0    # segmento freddo: JSON compatto di record (byte decompressi)
+INDEX_BYTES_PER_RECORD = 150   # DateIndex + serie costruite su un record
+
+class DocCache:
+    """LRU dei documenti già parsati, con budget in byte di memoria stimata.
+
+    Ogni voce costa `size` × factor (per i documenti: byte del file × DOC_PARSED_FACTOR),
+    più le strutture derivate registrate con charge().
+    """
+
+    def __init__(self, max_bytes, factor=1.0):
+        self.max_bytes = max_bytes
+        self.factor = factor
+        self.entries = OrderedDict()  # uid -> (stamp, costo, data, aux)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, uid, stamp):
+        with self.lock:
+            entry = self.entries.get(uid)
+            if entry is None or entry[0] != stamp:
+                return None
+            self.entries.move_to_end(uid)
+            return entry[2]
+
+    def put(self, uid, stamp, size, data):
+        cost = int(size * self.factor)
+        with self.lock:
+            self._drop(uid)
+            if cost > self.max_bytes:
+                return
+            self.entries[uid] = (stamp, cost, data, {})
+            self.total += cost
+            self._evict()
+
+    def charge(self, uid, data, nbytes):
+        """Aggiunge al costo del documento in cache una struttura derivata (in aux)."""
+        with self.lock:
+            entry = self.entries.get(uid)
+            if entry is None or entry[2] is not data:
+                return
+            self.entries[uid] = (entry[0], entry[1] + nbytes, entry[2], entry[3])
+            self.total += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.total -= evicted[1]
+
+    def aux(self, uid, data):
+        """Strutture derivate (indici) legate a `data` finché resta il documento in cache per uid."""
+        with self.lock:
+            entry = self.entries.get(uid)
+            return entry[3] if entry is not None and entry[2] is data else None
+
+    def aux_at(self, uid, stamp):
+        """Strutture derivate del documento in cache, se corrisponde ancora al file su disco."""
+        with self.lock:
+            entry = self.entries.get(uid)
+            return entry[3] if entry is not None and entry[0] == stamp else None
+
+    def drop(self, uid):
+        with self.lock:
+            self._drop(uid)
+
+    def _drop(self, uid):
+        entry = self.entries.pop(uid, None)
+        if entry is not None:
+            self.total -= entry[1]
+
+class JsonStore:
+    """Un file users/<uid>/data.json per utente (backend storico).
+
+    I documenti letti restano in DOC_CACHE finché il file su disco non cambia: vanno
+    trattati come sola lettura, chi deve modificarli li rilegge con cached=False.
+    """
+
+    def __init__(self, cache_bytes=0, write_behind=False):
+        self.cache = DocCache(cache_bytes, DOC_PARSED_FACTOR) if cache_bytes else None
+        self.behind = WriteBehind(self, FLUSH_INTERVAL, FLUSH_MAX_DIRTY) if write_behind else None
+
+    def read(self, uid, cached=True):
+        with phase("load"):
+            return self._read(uid, cached)
+
+    def _read(self, uid, cached):
+        pending = self.behind.get(uid) if self.behind is not None else None
+        if pending is not None:
+            # il documento in attesa di flush è quello buono; in scrittura se ne usa una copia
+            return pending[0] if cached else pickle.loads(pickle.dumps(pending[0], pickle.HIGHEST_PROTOCOL))
+        data_path, _ = user_dirs(uid)
+        try:
+            st = os.stat(data_path)
+        except FileNotFoundError:
+            return None
+        stamp = file_stamp(st)
+        note_doc_size(st.st_size)
+        if cached and self.cache is not None:
+            data = self.cache.get(uid, stamp)
+            if data is not None:
+                return data
+        with open(data_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if cached and self.cache is not None:
+            self.cache.put(uid, stamp, st.st_size, data)
+        return data
+
+    def write(self, uid, data):
+        if self.behind is None:
+            self.persist(uid, data)
+            return
+        data_path, _ = user_dirs(uid)
+        with phase("save"), user_lock(uid) as lock:
+            lock.keep_file_lock()
+            version = self.version(uid) + 1
+            self.behind.put(uid, data, version)
+            if self.cache is not None:
+                size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+                self.cache.put(uid, ("pending", version), size, data)
+
+    def persist(self, uid, data, version=None):
+        data_path, _ = user_dirs(uid, create=True)
+        with phase("save"), user_lock(uid):
+            # file temporaneo + fsync + rename: chi legge vede il documento vecchio o quello nuovo, mai a metà
+            tmp_path = f"{data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            version = version or self.version(uid) + 1
+            doc, index = data, data.get(EXERCISE_INDEX)
+            if index and "ex" in index:
+                doc = {**data, EXERCISE_INDEX: write_exercise_file(uid, index)}
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(doc, f, indent=2, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, data_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            # versione dopo il documento: chi legge prima la versione e poi i dati può avere un
+            # ETag vecchio con dati nuovi, mai il contrario (ETag e frammenti nuovi su dati vecchi)
+            self.bump_version(uid, version)
+            st = os.stat(data_path)
+            if self.cache is not None:
+                self.cache.put(uid, file_stamp(st), st.st_size, data)
+                if doc is not data:
+                    # l'indice esercizi resta nel documento in memoria ma non è nel file
+                    index_path = os.path.join(user_base(uid), doc[EXERCISE_INDEX]["file"])
+                    self.cache.charge(uid, data, int(os.path.getsize(index_path) * COMPACT_PARSED_FACTOR))
+            REGISTRY.touch(uid, st.st_size, st.st_mtime)
+            if doc is not data:
+                prune_exercise_files(uid, doc[EXERCISE_INDEX]["file"])
+            if COLD_SEGMENTS in data or os.path.isdir(cold_dir(uid)):
+                # solo ora che il documento su disco non li referenzia più
+                prune_segments(uid, {seg["file"] for seg in (data.get(COLD_SEGMENTS) or {}).values()})
+
+    def transaction(self, uid, write=True):
+        return JsonTransaction(self, uid, write)
+
+    def version(self, uid):
+        """Versione dei dati dell'utente: cresce a ogni salvataggio (0 se mai salvato)."""
+        pending = self.behind.get(uid) if self.behind is not None else None
+        if pending is not None:
+            return pending[1]
+        base = user_base(uid)
+        try:
+            with open(os.path.join(base, "version"), encoding="ascii") as f:
+                version = int(f.read() or 0)
+                written = os.fstat(f.fileno()).st_mtime_ns
+        except (FileNotFoundError, ValueError):
+            return 0
+        try:
+            # documento più recente della versione: processo morto tra os.replace e bump_version
+            if os.stat(os.path.join(base, "data.json")).st_mtime_ns > written:
+                return version + 1
+        except FileNotFoundError:
+            pass
+        return version
+
+    def bump_version(self, uid, version):
+        # chiamata sotto user_lock, dopo aver sostituito data.json
+        path = os.path.join(user_base(uid), "version")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="ascii") as f:
+            f.write(str(version))
+        os.replace(tmp_path, path)
+
+    def exercise_file(self, uid, data, name, private=False):
+        """Indice esercizi referenziato da `data`; in sola lettura resta legato al documento in cache."""
+        aux = self.cache.aux(uid, data) if self.cache is not None and not private else None
+        if aux is None:
+            return read_exercise_file(uid, name)
+        if aux.get("exercise_file", (None,))[0] != name:
+            aux["exercise_file"] = (name, read_exercise_file(uid, name))
+            try:
+                self.cache.charge(uid, data, int(os.path.getsize(os.path.join(user_base(uid), name))
+                                                 * COMPACT_PARSED_FACTOR))
+            except FileNotFoundError:
+                pass
+        return aux["exercise_file"][1]
+
+    def date_index(self, uid, data):
+        aux = self.cache.aux(uid, data) if self.cache is not None else None
+        if aux is None:
+            return DateIndex(data)
+        if "dates" not in aux:
+            aux["dates"] = DateIndex(data)
+            self._charge_index(uid, data)
+        return aux["dates"]
+
+    def attach_index(self, uid, data, index):
+        # dopo un salvataggio l'indice della transazione resta valido per il documento in cache
+        aux = self.cache.aux(uid, data) if self.cache is not None else None
+        if aux is not None:
+            aux["dates"] = index
+            self._charge_index(uid, data)
+
+    def _charge_index(self, uid, data):
+        records = sum(len(data.get(coll) or []) for coll in COLLECTIONS)
+        self.cache.charge(uid, data, records * INDEX_BYTES_PER_RECORD)
+
+    def cached_series(self, uid, data):
+        """Copia delle serie già costruite sul documento in cache, da riusare in scrittura (sotto lock)."""
+        if self.cache is None:
+            return None
+        data_path, _ = user_dirs(uid)
+        try:
+            stamp = file_stamp(os.stat(data_path))
+        except FileNotFoundError:
+            return None
+        aux = self.cache.aux_at(uid, stamp)
+        index = aux.get("dates") if aux else None
+        if index is None or index._series is None:
+            return None
+        return index._series.copy(data)
+
+    def user_ids(self):
+        if not REGISTRY.scanned():
+            self.rebuild_registry()
+        return REGISTRY.user_ids()
+
+    def scan_users(self):
+        """(uid, data.json) di tutti gli utenti, percorrendo l'albero: solo per ricostruire il registro."""
+        shard = re.compile(r"[0-9a-f]{2}")
+        for a in sorted(os.listdir(USERS_DIR)):
+            path = os.path.join(USERS_DIR, a)
+            if os.path.isfile(os.path.join(path, "data.json")):
+                yield a, os.path.join(path, "data.json")  # layout piatto, prima della migrazione
+            if not (shard.fullmatch(a) and os.path.isdir(path)):
+                continue
+            for b in sorted(os.listdir(path)):
+                if not (shard.fullmatch(b) and os.path.isdir(os.path.join(path, b))):
+                    continue
+                for uid in sorted(os.listdir(os.path.join(path, b))):
+                    data_path = os.path.join(path, b, uid, "data.json")
+                    if os.path.isfile(data_path):
+                        yield uid, data_path
+
+    def rebuild_registry(self):
+        since = time.time()
+        entries = []
+        for uid, path in self.scan_users():
+            st = os.stat(path)
+            entries.append((uid, st.st_size, st.st_mtime))
+        REGISTRY.replace(entries, since)
+        return len(entries)
+
+    def read_full(self, uid):
+        """Documento completo: quello caldo con i segmenti freddi reinseriti."""
+        data = self.read(uid, cached=False)
+        if data is None:
+            return None
+        cold = {coll: [] for coll in COLLECTIONS}
+        for period, seg in sorted((data.pop(COLD_SEGMENTS, None) or {}).items()):
+            rows = read_segment(uid, seg["file"], cached=False)
+            for coll in COLLECTIONS:
+                cold[coll] += rows.get(coll, [])
+        for coll in COLLECTIONS:
+            data[coll] = cold[coll] + data.get(coll, [])
+        if "file" in (data.get(EXERCISE_INDEX) or {}):
+            data[EXERCISE_INDEX] = read_exercise_file(uid, data[EXERCISE_INDEX]["file"])
+        return data
+
+class WriteBehind:
+    """Salvataggi in ritardo per JsonStore: più salvataggi dello stesso utente nella finestra
+    diventano una sola scrittura, fatta dal thread di flush.
+
+    Finché l'utente ha modifiche in memoria il processo tiene il suo flock: gli altri worker
+    che vogliono scrivere aspettano il flush invece di partire da un file vecchio, mentre le
+    loro letture vedono il file su disco (al più FLUSH_INTERVAL secondi indietro).
+    """
+
+    def __init__(self, store, interval, max_dirty):
+        self.store = store
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.pending = {}  # uid -> (documento, versione)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.saves = 0
+        self.flushes = 0
+
+    def get(self, uid):
+        with self.lock:
+            return self.pending.get(uid)
+
+    def put(self, uid, data, version):
+        # chiamata sotto user_lock(uid)
+        with self.lock:
+            self.pending[uid] = (data, version)
+            self.saves += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            full = len(self.pending) >= self.max_dirty
+        if full:
+            self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            uids = list(self.pending)
+        for uid in uids:
+            self.flush_user(uid)
+
+    def flush_user(self, uid):
+        with user_lock(uid):
+            pending = self.get(uid)
+            if pending is None:
+                return
+            try:
+                self.store.persist(uid, *pending)
+            except Exception:
+                # resta in memoria: si riprova al prossimo giro
+                app.logger.exception("write-behind: salvataggio di %s non riuscito", uid)
+                return
+            with self.lock:
+                del self.pending[uid]
+                self.flushes += 1
+            release_file_lock(uid)
+
+def flush_pending():
+    """Scrive su disco i salvataggi ancora in memoria (uscita del processo, worker_exit di gunicorn)."""
+    behind = getattr(STORE, "behind", None)
+    if behind is not None:
+        behind.flush()
+
+class DateIndex:
+    """Per ogni collezione: data -> posizioni dei record nella lista del documento.
+
+    Get e upsert per data sono O(1) e modificano la lista sul posto;
+    solo la cancellazione (rara) ricalcola le posizioni della collezione.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = {}
+        self._series = None
+        for coll in COLLECTIONS:
+            self._build(coll)
+
+    @property
+    def series(self):
+        if self._series is None:
+            self._series = SeriesIndex(self.data)
+        return self._series
+
+    def _touch(self, coll, date_iso):
+        # le serie già costruite si aggiornano solo per il giorno modificato
+        if self._series is not None:
+            self._series.reset_day(coll, date_iso, self.all(coll, date_iso))
+
+    def _build(self, coll):
+        idx = {}
+        for i, r in enumerate(self.data.get(coll) or []):
+            idx.setdefault(r.get("data"), []).append(i)
+        self.pos[coll] = idx
+
+    def get(self, coll, date_iso):
+        p = self.pos[coll].get(date_iso)
+        return self.data[coll][p[0]] if p else None
+
+    def all(self, coll, date_iso):
+        rows = self.data.get(coll) or []
+        return [rows[i] for i in self.pos[coll].get(date_iso, ())]
+
+    def append(self, coll, record):
+        rows = self.data.setdefault(coll, [])
+        rows.append(record)
+        self.pos[coll].setdefault(record.get("data"), []).append(len(rows) - 1)
+        self._touch(coll, record.get("data"))
+
+    def replace_first(self, coll, record):
+        p = self.pos[coll].get(record.get("data"))
+        if not p:
+            self.append(coll, record)
+        else:
+            self.data[coll][p[0]] = record
+            self._touch(coll, record.get("data"))
+
+    def upsert(self, coll, record):
+        """Un solo record per data: sostituisce il primo ed elimina gli eventuali duplicati."""
+        p = self.pos[coll].get(record.get("data"))
+        if p and len(p) > 1:
+            self._delete(coll, p[1:])
+        self.replace_first(coll, record)
+
+    def delete(self, coll, date_iso):
+        self._delete(coll, self.pos[coll].get(date_iso, ()))
+
+    def _delete(self, coll, positions):
+        if not positions:
+            return
+        rows = self.data[coll]
+        dates = {rows[i].get("data") for i in positions}
+        for i in sorted(positions, reverse=True):
+            del rows[i]
+        self._build(coll)
+        for d in dates:
+            self._touch(coll, d)
+
+def iso_date(dstr):
+    try:
+        return datetime.date.fromisoformat(dstr).isoformat() == dstr
+    except Exception:
+        return False
+
+def series_value(name, r):
+    """Valore di un record per la serie `name`: foto, misure o un campo numerico (valore, non vuoto)."""
+    if name == "foto":
+        return {"data": r.get("data"), "url": r["foto"], "thumb": photo_thumb_url(r["foto"])} if r.get("foto") else None
+    if name == "misure":
+        mis = r.get("misure") or {}
+        return {"data": r.get("data"), **mis} if any(mis.values()) else None
+    try:
+        return (float(r.get(name)), bool(r.get(name)))
+    except Exception:
+        return None
+
+class DatedSeries:
+    """Valori ordinati per data: 'al giorno X', ultimo valore e intervalli con bisect.
+
+    Per ogni giorno i valori restano nell'ordine della lista; le date non ISO
+    contano solo per newest().
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.vals = {}
+        self.loose = {}
+
+    def copy(self):
+        new = DatedSeries()
+        new.keys = list(self.keys)
+        new.vals = {k: list(v) for k, v in self.vals.items()}
+        new.loose = {k: list(v) for k, v in self.loose.items()}
+        return new
+
+    def add(self, dstr, value):
+        if iso_date(dstr):
+            if dstr not in self.vals:
+                bisect.insort(self.keys, dstr)
+                self.vals[dstr] = []
+            self.vals[dstr].append(value)
+        else:
+            self.loose.setdefault(dstr or "", []).append(value)
+
+    def drop(self, dstr):
+        if self.vals.pop(dstr, None) is not None:
+            del self.keys[bisect.bisect_left(self.keys, dstr)]
+        self.loose.pop(dstr or "", None)
+
+    def as_of(self, ref_iso):
+        """(data, valore) con data <= ref, dal più recente (a parità di giorno, dall'ultimo inserito)."""
+        i = bisect.bisect_right(self.keys, ref_iso)
+        while i > 0:
+            i -= 1
+            k = self.keys[i]
+            for v in reversed(self.vals[k]):
+                yield k, v
+
+    def newest(self):
+        """Tutte le coppie (data, valore) per data decrescente (a parità di giorno, nell'ordine della lista)."""
+        keys = reversed(self.keys) if not self.loose else sorted([*self.vals, *self.loose], reverse=True)
+        for k in keys:
+            for v in self.vals.get(k) or self.loose[k]:
+                yield k, v
+
+    def between(self, date_from=None, date_to=None):
+        lo = bisect.bisect_left(self.keys, date_from) if date_from else 0
+        hi = bisect.bisect_right(self.keys, date_to) if date_to else len(self.keys)
+        for k in self.keys[lo:hi]:
+            for v in self.vals[k]:
+                yield k, v
+
+class SeriesIndex:
+    """Serie per (collezione, campo) costruite al primo uso sul documento."""
+
+    def __init__(self, data):
+        self.data = data
+        self.series = {}
+
+    def copy(self, data):
+        new = SeriesIndex(data)
+        new.series = {key: s.copy() for key, s in self.series.items()}
+        return new
+
+    def get(self, coll, name):
+        s = self.series.get((coll, name))
+        if s is None:
+            s = DatedSeries()
+            for r in self.data.get(coll) or []:
+                v = series_value(name, r)
+                if v is not None:
+                    s.add(r.get("data"), v)
+            self.series[(coll, name)] = s
+        return s
+
+    def reset_day(self, coll, date_iso, rows):
+        for (c, name), s in self.series.items():
+            if c != coll:
+                continue
+            s.drop(date_iso)
+            for r in rows:
+                v = series_value(name, r)
+                if v is not None:
+                    s.add(date_iso, v)
+
+def dated_values(rows, name, date_from=None, date_to=None):
+    """Come DatedSeries.between, per i backend che restituiscono righe già filtrate."""
+    out = []
+    for r in rows:
+        d = r.get("data")
+        if not iso_date(d) or (date_from and d < date_from) or (date_to and d > date_to):
+            continue
+        v = series_value(name, r)
+        if v is not None:
+            out.append((d, v))
+    out.sort(key=lambda p: p[0])
+    return out
+
+# ===================== TIERING (segmenti freddi, backend JSON) =====================
+# tier-data sposta i mesi interi più vecchi di COLD_AFTER_DAYS da data.json a
+# users/<uid>/cold/<AAAA-MM>.<hash>.json.gz: JSON compatto e compresso, di sola lettura
+# (il nome dipende dal contenuto, quindi si può tenere in cache per nome). L'elenco dei
+# segmenti con il loro intervallo di date sta nella sezione COLD_SEGMENTS del documento
+# caldo, che resta il punto di commit. Scrivere su un mese archiviato lo riporta nel
+# documento caldo; i file non più referenziati si cancellano dopo il salvataggio.
+COLD_SEGMENTS = "cold_segments"
+
+def cold_dir(uid):
+    return os.path.join(user_base(uid), "cold")
+
+def write_segment(uid, period, rows):
+    """Scrive un segmento {collezione: record} e ne ritorna la voce di indice."""
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    name = f"{period}.{hashlib.sha1(raw).hexdigest()[:12]}.json.gz"
+    folder = cold_dir(uid)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(gzip.compress(raw, mtime=0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    dates = [r["data"] for recs in rows.values() for r in recs]
+    return {"file": name, "from": min(dates), "to": max(dates),
+            "counts": {coll: len(recs) for coll, recs in rows.items()}}
+
+# Il nome del segmento cambia con il contenuto: in cache basta il percorso, senza stamp.
+SEGMENT_CACHE = DocCache(COLD_CACHE_BYTES, SEGMENT_PARSED_FACTOR)
+
+def read_segment(uid, name, cached=True):
+    """{collezione: record} di un segmento; quelli in cache sono condivisi, da non modificare."""
+    path = os.path.join(cold_dir(uid), name)
+    rows = SEGMENT_CACHE.get(path, name) if cached else None
+    if rows is None:
+        with gzip.open(path, "rb") as f:
+            raw = f.read()
+        rows = json.loads(raw)
+        if cached:
+            SEGMENT_CACHE.put(path, name, len(raw), rows)
+    return rows
+
+def prune_segments(uid, keep):
+    """Cancella i segmenti non più referenziati dal documento salvato (sotto user_lock)."""
+    try:
+        names = os.listdir(cold_dir(uid))
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name not in keep:
+            os.remove(os.path.join(cold_dir(uid), name))
+
+# ===================== INDICE ESERCIZI SU FILE (backend JSON) =====================
+# L'indice esercizi contiene ogni set di ogni sessione: in data.json (indentato, riscritto a
+# ogni salvataggio) sarebbe la parte più grossa del documento caldo. Si salva a parte, in
+# users/<uid>/exercise_index.<hash>.json compatto; data.json tiene solo {"file": nome}.
+# Come per i segmenti freddi il nome dipende dal contenuto: il commit resta data.json.
+def write_exercise_file(uid, index):
+    raw = json.dumps(index, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    name = f"exercise_index.{hashlib.sha1(raw).hexdigest()[:12]}.json"
+    path = os.path.join(user_base(uid), name)
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    return {"file": name}
+
+def read_exercise_file(uid, name):
+    """Indice salvato da write_exercise_file; {} se manca (verrà ricostruito dalle sessioni)."""
+    try:
+        with open(os.path.join(user_base(uid), name), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def prune_exercise_files(uid, keep):
+    # sotto user_lock, dopo il salvataggio di data.json
+    base = user_base(uid)
+    for name in os.listdir(base):
+        if name.startswith("exercise_index.") and name.endswith(".json") and name != keep:
+            os.remove(os.path.join(base, name))
+
+class JsonTransaction:
+    """Il documento viene caricato al primo accesso e salvato una sola volta all'uscita.
+
+    In scrittura tiene il lock dell'utente per tutto il load -> modifica -> save.
+    """
+
+    def __init__(self, store, uid, write=True):
+        self.store = store
+        self.uid = uid
+        self.write = write
+        self.dirty = False
+        self._data = None
+        self._index = None
+        self._lock = user_lock(uid) if write else None
+
+    def __enter__(self):
+        if self._lock is not None:
+            with phase("lock"):
+                self._lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and self.write and self.dirty:
+                save_data(self._data, self.uid)
+                if self._index is not None:
+                    self.store.attach_index(self.uid, self._data, self._index)
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+        return False
+
+    @property
+    def data(self):
+        if self._data is None:
+            if not self.write:
+                self._data = load_data(self.uid)
+            else:
+                # in scrittura si lavora su una copia privata, mai sull'oggetto in cache
+                self._data = self.store.read(self.uid, cached=False)
+                if self._data is None:
+                    self._data = default_data()
+                    self.dirty = True
+        return self._data
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.store.date_index(self.uid, self.data)
+            if self.write and not self.dirty and self._index._series is None:
+                self._index._series = self.store.cached_series(self.uid, self.data)
+        return self._index
+
+    def records(self, coll):
+        return self.data.setdefault(coll, [])
+
+    def _cold(self):
+        return self.data.get(COLD_SEGMENTS) or {}
+
+    def _cold_segments(self, date_from=None, date_to=None):
+        """Segmenti freddi che si sovrappongono a [date_from, date_to], in ordine di data."""
+        segs = self._cold()
+        return [segs[p] for p in sorted(segs)
+                if (date_from is None or segs[p]["to"] >= date_from) and (date_to is None or segs[p]["from"] <= date_to)]
+
+    def _cold_rows(self, coll, date_from=None, date_to=None):
+        for seg in self._cold_segments(date_from, date_to):
+            if seg["counts"].get(coll):
+                yield from read_segment(self.uid, seg["file"]).get(coll, ())
+
+    def _cold_day(self, coll, date_iso):
+        # None se il mese non è archiviato (e quindi il giorno sta nel documento caldo)
+        seg = self._cold().get((date_iso or "")[:7])
+        if seg is None:
+            return None
+        return [r for r in read_segment(self.uid, seg["file"]).get(coll, ()) if r.get("data") == date_iso]
+
+    def _thaw(self, date_iso=None):
+        """Riporta nel documento caldo il mese di date_iso (tutti i mesi se None), se archiviato."""
+        segs = self._cold()
+        periods = [p for p in segs if date_iso is None or p == (date_iso or "")[:7]]
+        for period in periods:
+            rows = read_segment(self.uid, segs.pop(period)["file"], cached=False)
+            for coll in COLLECTIONS:
+                for r in rows.get(coll, ()):
+                    self.index.append(coll, r)
+            self.dirty = True
+
+    def get_day(self, coll, date_iso):
+        cold = self._cold_day(coll, date_iso)
+        if cold is not None:
+            return cold[0] if cold else None
+        return self.index.get(coll, date_iso)
+
+    def records_on(self, coll, date_iso):
+        cold = self._cold_day(coll, date_iso)
+        return cold if cold is not None else self.index.all(coll, date_iso)
+
+    def range(self, coll, date_from=None, date_to=None):
+        return list(self.iter_range(coll, date_from, date_to))
+
+    def iter_range(self, coll, date_from=None, date_to=None):
+        for r in itertools.chain(self._cold_rows(coll, date_from, date_to), self.records(coll)):
+            d = r.get("data") or ""
+            if date_from is not None and d < date_from: continue
+            if date_to is not None and d > date_to: continue
+            yield r
+
+    def section_names(self):
+        return [k for k in self.data if k not in COLLECTIONS]
+
+    def latest_float(self, coll, field, on_or_before=None):
+        s = self.index.series.get(coll, field)
+        ref = None
+        if on_or_before is None:
+            vals = s.newest()
+        else:
+            ref = (parse_date(on_or_before) if isinstance(on_or_before, str) else on_or_before).isoformat()
+            vals = s.as_of(ref)
+        hot = next(((d, v) for d, (v, filled) in vals if filled), None)
+        # un mese archiviato più recente del valore trovato può averne uno più nuovo
+        for seg in reversed(self._cold_segments(hot and hot[0], ref)):
+            rows = [r for r in read_segment(self.uid, seg["file"]).get(coll, ()) if ref is None or r["data"] <= ref]
+            if ref is not None:
+                rows.reverse()
+            rows.sort(key=itemgetter("data"), reverse=True)
+            v = first_float((r for r in rows if hot is None or r["data"] > hot[0]), field)
+            if v is not None:
+                return v
+        return hot[1] if hot else None
+
+    def _between(self, coll, name, date_from, date_to):
+        hot = list(self.index.series.get(coll, name).between(date_from, date_to))
+        if not self._cold():
+            return hot
+        cold = dated_values(self._cold_rows(coll, date_from, date_to), name, date_from, date_to)
+        return sorted(cold + hot, key=itemgetter(0))
+
+    def values_between(self, coll, field, date_from=None, date_to=None):
+        return [(d, v[0]) for d, v in self._between(coll, field, date_from, date_to)]
+
+    def photos_between(self, date_from=None, date_to=None):
+        return [v for _, v in self._between("allenamenti", "foto", date_from, date_to)]
+
+    def measures_between(self, date_from=None, date_to=None):
+        return [v for _, v in self._between("allenamenti", "misure", date_from, date_to)]
+
+    def archive(self, before_iso):
+        """Sposta nei segmenti freddi i mesi interi precedenti a quello di before_iso; ritorna i record spostati."""
+        periods = {}
+        for coll in COLLECTIONS:
+            keep = []
+            for r in self.records(coll):
+                d = r.get("data")
+                if iso_date(d) and d[:7] < before_iso[:7]:
+                    periods.setdefault(d[:7], {}).setdefault(coll, []).append(r)
+                else:
+                    keep.append(r)
+            self.data[coll] = keep
+        if not periods:
+            return 0
+        segs = self.data.setdefault(COLD_SEGMENTS, {})
+        for period, rows in sorted(periods.items()):
+            if period in segs:  # non dovrebbe succedere: le scritture riportano il mese nel documento caldo
+                old = read_segment(self.uid, segs[period]["file"], cached=False)
+                rows = {c: old.get(c, []) + rows.get(c, []) for c in COLLECTIONS if old.get(c) or rows.get(c)}
+            segs[period] = write_segment(self.uid, period, rows)
+        self._index = None
+        self.dirty = True
+        return sum(len(recs) for rows in periods.values() for recs in rows.values())
+
+    def get_section(self, name):
+        section = self.data.get(name) or {}
+        if name == EXERCISE_INDEX and "file" in section:
+            section = self.store.exercise_file(self.uid, self.data, section["file"], private=self.write)
+        return section
+
+    def put_section(self, name, value):
+        self.data[name] = value
+        self.dirty = True
+
+    def put_day(self, coll, record):
+        self._thaw(record.get("data"))
+        self.index.replace_first(coll, record)
+        self.dirty = True
+
+    def upsert_day(self, coll, record):
+        self._thaw(record.get("data"))
+        self.index.upsert(coll, record)
+        self.dirty = True
+
+    def delete_day(self, coll, date_iso):
+        self._thaw(date_iso)
+        self.index.delete(coll, date_iso)
+        self.dirty = True
+
+    def append(self, coll, record):
+        self._thaw(record.get("data"))
+        self.index.append(coll, record)
+        self.dirty = True
+
+    def update_records(self, coll, fn):
+        """fn modifica il record in place e ritorna True se è cambiato; ritorna quanti sono cambiati."""
+        changed = sum(1 for r in self.records(coll) if fn(r))
+        segs = self._cold()
+        for period, seg in list(segs.items()):
+            if not seg["counts"].get(coll):
+                continue
+            # i segmenti non si modificano: se cambia qualcosa se ne scrive uno nuovo
+            rows = read_segment(self.uid, seg["file"], cached=False)
+            n = sum(1 for r in rows[coll] if fn(r))
+            if n:
+                segs[period] = write_segment(self.uid, period, rows)
+                changed += n
+        if changed:
+            self.dirty = True
+        return changed
+
+    def replace(self, data):
+        self._data = data
+        self._index = None
+        self.dirty = True
+
+class SqliteStore:
+    """Un database SQLite condiviso: una tabella per collezione, indicizzata su (uid, data)."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS giornaliero (id INTEGER PRIMARY KEY, uid TEXT NOT NULL, data TEXT NOT NULL, doc TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS giornaliero_uid_data ON giornaliero(uid, data);
+        CREATE TABLE IF NOT EXISTS allenamenti (id INTEGER PRIMARY KEY, uid TEXT NOT NULL, data TEXT NOT NULL, doc TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS allenamenti_uid_data ON allenamenti(uid, data);
+        CREATE TABLE IF NOT EXISTS alimentazione (id INTEGER PRIMARY KEY, uid TEXT NOT NULL, data TEXT NOT NULL, doc TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS alimentazione_uid_data ON alimentazione(uid, data);
+        CREATE TABLE IF NOT EXISTS goals (uid TEXT PRIMARY KEY, doc TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS meal_plan (uid TEXT PRIMARY KEY, doc TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS extra (uid TEXT NOT NULL, key TEXT NOT NULL, doc TEXT NOT NULL, PRIMARY KEY (uid, key));
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.conn()
+        conn.executescript(self.SCHEMA)
+        if "version" not in [col[1] for col in conn.execute("PRAGMA table_info(users)")]:
+            conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+        return c
+
+    def exists(self, uid, conn=None):
+        conn = conn or self.conn()
+        return conn.execute("SELECT 1 FROM users WHERE uid=?", (uid,)).fetchone() is not None
+
+    def read(self, uid, conn=None):
+        with phase("load"):
+            return self._read(uid, conn or self.conn())
+
+    def _read(self, uid, conn):
+        if not self.exists(uid, conn):
+            return None
+        data = {}
+        for coll in COLLECTIONS:
+            rows = conn.execute(f"SELECT doc FROM {coll} WHERE uid=? ORDER BY id", (uid,))
+            data[coll] = [json.loads(doc) for (doc,) in rows]
+        for name in SECTIONS:
+            row = conn.execute(f"SELECT doc FROM {name} WHERE uid=?", (uid,)).fetchone()
+            if row is not None:
+                data[name] = json.loads(row[0])
+        for key, doc in conn.execute("SELECT key, doc FROM extra WHERE uid=? ORDER BY key", (uid,)):
+            data[key] = json.loads(doc)
+        return data
+
+    def write(self, uid, data):
+        with self.transaction(uid) as tx:
+            tx.replace(data)
+
+    def transaction(self, uid, write=True):
+        return SqliteTransaction(self, uid, write)
+
+    def version(self, uid):
+        row = self.conn().execute("SELECT version FROM users WHERE uid=?", (uid,)).fetchone()
+        return row[0] if row else 0
+
+    def user_ids(self):
+        return [uid for (uid,) in self.conn().execute("SELECT uid FROM users ORDER BY uid")]
+
+class SqliteTransaction:
+    """Transazione SQLite (BEGIN IMMEDIATE in scrittura): ogni operazione tocca solo le righe della data."""
+
+    def __init__(self, store, uid, write=True):
+        self.store = store
+        self.uid = uid
+        self.write = write
+        self.conn = store.conn()
+
+    def __enter__(self):
+        if not self.write and not self.store.exists(self.uid, self.conn):
+            save_data(default_data(), self.uid)
+        # anche in lettura una transazione, così tutte le query vedono lo stesso snapshot
+        with phase("lock"):
+            self.conn.execute("BEGIN IMMEDIATE" if self.write else "BEGIN")
+        if self.write and not self.store.exists(self.uid, self.conn):
+            self._replace(default_data())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with phase("save" if self.write else "load"):
+            if exc_type is None and self.write:
+                self.conn.execute("UPDATE users SET version = version + 1 WHERE uid=?", (self.uid,))
+            self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+    @property
+    def data(self):
+        return self.store.read(self.uid, self.conn)
+
+    def get_day(self, coll, date_iso):
+        row = self.conn.execute(f"SELECT doc FROM {coll} WHERE uid=? AND data=? ORDER BY id LIMIT 1",
+                                (self.uid, date_iso)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def records_on(self, coll, date_iso):
+        return self.range(coll, date_iso, date_iso)
+
+    def range(self, coll, date_from=None, date_to=None):
+        return list(self.iter_range(coll, date_from, date_to))
+
+    def iter_range(self, coll, date_from=None, date_to=None):
+        sql, args = f"SELECT doc FROM {coll} WHERE uid=?", [self.uid]
+        if date_from is not None:
+            sql += " AND data>=?"; args.append(date_from)
+        if date_to is not None:
+            sql += " AND data<=?"; args.append(date_to)
+        for (doc,) in self.conn.execute(sql + " ORDER BY id", args):
+            yield json.loads(doc)
+
+    def section_names(self):
+        names = [name for name in SECTIONS
+                 if self.conn.execute(f"SELECT 1 FROM {name} WHERE uid=?", (self.uid,)).fetchone()]
+        return names + [k for (k,) in self.conn.execute("SELECT key FROM extra WHERE uid=? ORDER BY key", (self.uid,))]
+
+    def latest_float(self, coll, field, on_or_before=None):
+        if on_or_before is None:
+            rows = self.conn.execute(f"SELECT doc FROM {coll} WHERE uid=? ORDER BY data DESC, id", (self.uid,))
+            return first_float((json.loads(doc) for (doc,) in rows), field)
+        ref = parse_date(on_or_before) if isinstance(on_or_before, str) else on_or_before
+        rows = self.conn.execute(f"SELECT data, doc FROM {coll} WHERE uid=? AND data<=? ORDER BY data DESC, id DESC",
+                                 (self.uid, ref.isoformat()))
+        def valid():
+            for d, doc in rows:
+                try:
+                    datetime.date.fromisoformat(d)
+                except Exception:
+                    continue
+                yield json.loads(doc)
+        return first_float(valid(), field)
+
+    def values_between(self, coll, field, date_from=None, date_to=None):
+        return [(d, v[0]) for d, v in dated_values(self.iter_range(coll, date_from, date_to), field)]
+
+    def photos_between(self, date_from=None, date_to=None):
+        return [v for _, v in dated_values(self.iter_range("allenamenti", date_from, date_to), "foto")]
+
+    def measures_between(self, date_from=None, date_to=None):
+        return [v for _, v in dated_values(self.iter_range("allenamenti", date_from, date_to), "misure")]
+
+    def get_section(self, name):
+        if name in SECTIONS:
+            row = self.conn.execute(f"SELECT doc FROM {name} WHERE uid=?", (self.uid,)).fetchone()
+        else:
+            row = self.conn.execute("SELECT doc FROM extra WHERE uid=? AND key=?", (self.uid, name)).fetchone()
+        return (json.loads(row[0]) if row else None) or {}
+
+    def put_section(self, name, value):
+        doc = json.dumps(value, ensure_ascii=False)
+        if name in SECTIONS:
+            self.conn.execute(f"INSERT OR REPLACE INTO {name} (uid, doc) VALUES (?, ?)", (self.uid, doc))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO extra (uid, key, doc) VALUES (?, ?, ?)", (self.uid, name, doc))
+
+    def put_day(self, coll, record):
+        doc = json.dumps(record, ensure_ascii=False)
+        row = self.conn.execute(f"SELECT id FROM {coll} WHERE uid=? AND data=? ORDER BY id LIMIT 1",
+                                (self.uid, record.get("data") or "")).fetchone()
+        if row:
+            self.conn.execute(f"UPDATE {coll} SET doc=? WHERE id=?", (doc, row[0]))
+        else:
+            self.append(coll, record)
+
+    def upsert_day(self, coll, record):
+        ids = [i for (i,) in self.conn.execute(f"SELECT id FROM {coll} WHERE uid=? AND data=? ORDER BY id",
+                                                (self.uid, record.get("data") or ""))]
+        if not ids:
+            self.append(coll, record)
+            return
+        self.conn.execute(f"UPDATE {coll} SET doc=? WHERE id=?", (json.dumps(record, ensure_ascii=False), ids[0]))
+        if len(ids) > 1:
+            self.conn.executemany(f"DELETE FROM {coll} WHERE id=?", [(i,) for i in ids[1:]])
+
+    def delete_day(self, coll, date_iso):
+        self.conn.execute(f"DELETE FROM {coll} WHERE uid=? AND data=?", (self.uid, date_iso))
+
+    def append(self, coll, record):
+        self.conn.execute(f"INSERT INTO {coll} (uid, data, doc) VALUES (?, ?, ?)",
+                          (self.uid, record.get("data") or "", json.dumps(record, ensure_ascii=False)))
+
+    def update_records(self, coll, fn, batch=500):
+        # a blocchi per id, senza caricare tutta la collezione
+        changed, last = 0, 0
+        while True:
+            rows = self.conn.execute(f"SELECT id, doc FROM {coll} WHERE uid=? AND id>? ORDER BY id LIMIT ?",
+                                     (self.uid, last, batch)).fetchall()
+            if not rows:
+                return changed
+            updates = []
+            for row_id, doc in rows:
+                rec = json.loads(doc)
+                if fn(rec):
+                    updates.append((json.dumps(rec, ensure_ascii=False), row_id))
+            self.conn.executemany(f"UPDATE {coll} SET doc=? WHERE id=?", updates)
+            changed += len(updates)
+            last = rows[-1][0]
+
+    def replace(self, data):
+        self._replace(data)
+
+    def _replace(self, data):
+        uid = self.uid
+        self.conn.execute("INSERT OR IGNORE INTO users (uid) VALUES (?)", (uid,))
+        for table in COLLECTIONS + SECTIONS + ("extra",):
+            self.conn.execute(f"DELETE FROM {table} WHERE uid=?", (uid,))
+        for key, val in data.items():
+            if key in COLLECTIONS:
+                self.conn.executemany(f"INSERT INTO {key} (uid, data, doc) VALUES (?, ?, ?)",
+                                      [(uid, r.get("data") or "", json.dumps(r, ensure_ascii=False)) for r in val])
+            else:
+                self.put_section(key, val)
+
+def make_store(backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return SqliteStore(SQLITE_PATH)
+    if backend == "json":
+        return JsonStore(DOC_CACHE_BYTES, write_behind=WRITE_BEHIND)
+    raise ValueError(f"STORAGE_BACKEND sconosciuto: {backend}")
+
+STORE = make_store()
+
+@app.cli.command("migrate-sqlite")
+def migrate_sqlite_command():
+    """Copia tutti i users/<uid>/data.json nel database SQLite (SQLITE_PATH)."""
+    src, dst = JsonStore(), SqliteStore(SQLITE_PATH)
+    count = 0
+    for uid in src.user_ids():
+        dst.write(uid, src.read_full(uid))
+        count += 1
+        click.echo(f"{uid}: ok")
+    click.echo(f"Migrati {count} utenti in {SQLITE_PATH}")
+
+def diary_day(tx, date_iso):
+    """Riga di giornaliero per la data (creata vuota se manca); va riscritta con tx.put_day."""
+    diary = tx.get_day("giornaliero", date_iso)
+    if diary is None:
+        diary = {"data": date_iso,
+                 "creatina":False,"preworkout":False,"termogenico":False,"proteine":False,
+                 "q_creatina_g":"","q_preworkout_pill":"","q_termogenico_pill":"","q_proteine_g":"",
+                 "peso":"","vita":"","fianchi":"","note":""}
+    return diary
 
 def uploads_url(user_id):
     return f"/user_uploads/{user_id}"
@@ -62,6 +1387,82 @@ def uploads_url(user_id):
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_IMG
 
+# ===================== FOTO (per contenuto) =====================
+# uploads/<sha256>.<ext>: la stessa foto ricaricata non viene duplicata e il file non cambia
+# mai, quindi si può servire come immutable. Anteprime in uploads/thumbs/<sha256>.jpg,
+# generate in background da un piccolo pool di thread.
+PHOTO_HASH_RE = re.compile(r"[0-9a-f]{64}")
+THUMBS_SUBDIR = "thumbs"
+_thumb_pool = None
+_thumb_pending = set()
+_thumb_lock = threading.Lock()
+
+def store_photo(stream, ext, up_dir):
+    """Salva la foto con nome = hash del contenuto; ritorna il nome del file."""
+    ext = ext.lower()
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=up_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(64 * 1024), b""):
+                h.update(chunk)
+                out.write(chunk)
+        name = f"{h.hexdigest()}.{ext}"
+        path = os.path.join(up_dir, name)
+        if os.path.exists(path):
+            os.remove(tmp)
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return name
+
+def thumb_name(name):
+    digest, _, ext = name.rpartition(".")
+    return f"{THUMBS_SUBDIR}/{digest}.jpg" if PHOTO_HASH_RE.fullmatch(digest) and ext in ALLOWED_IMG else None
+
+def photo_thumb_url(url):
+    """URL dell'anteprima di una foto salvata per contenuto (l'originale se non c'è Pillow o è un file vecchio)."""
+    base, _, name = (url or "").rpartition("/")
+    thumb = thumb_name(name) if Image is not None else None
+    return f"{base}/{thumb}" if thumb else url
+
+def make_thumb(src, dst):
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".part")
+        with os.fdopen(fd, "wb") as out:
+            im.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+    os.replace(tmp, dst)
+
+def _thumb_job(src, dst):
+    try:
+        make_thumb(src, dst)
+    except Exception:
+        app.logger.exception("anteprima non generata: %s", src)
+    finally:
+        with _thumb_lock:
+            _thumb_pending.discard(dst)
+
+def queue_thumb(up_dir, name):
+    """Accoda la generazione dell'anteprima (se manca e non è già in coda)."""
+    global _thumb_pool
+    thumb = thumb_name(name)
+    if Image is None or not thumb:
+        return
+    dst = os.path.join(up_dir, thumb)
+    with _thumb_lock:
+        if dst in _thumb_pending or os.path.exists(dst):
+            return
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if _thumb_pool is None:
+            _thumb_pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumbs")
+        _thumb_pending.add(dst)
+    _thumb_pool.submit(_thumb_job, os.path.join(up_dir, name), dst)
+
 # ===================== AFTER REQUEST: cookie utente =====================
 @app.after_request
 def set_user_cookie(resp):
@@ -70,6 +1471,372 @@ def set_user_cookie(resp):
         resp.set_cookie("u", sanitize_user_id(uid), max_age=60*60*24*365)
     return resp
 
+# ===================== METRICHE =====================
+# Per processo: con più worker gunicorn ogni scrape di /metrics vede un solo worker.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DOC_SIZE_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def lines(self, name, labels):
+        out, cum = [], 0
+        for le, n in zip((*self.buckets, "+Inf"), self.counts):
+            cum += n
+            out.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cum}')
+        tail = f"{{{labels}}}" if labels else ""
+        out.append(f"{name}_sum{tail} {self.sum}")
+        out.append(f"{name}_count{tail} {self.count}")
+        return out
+
+USER_BUCKETS = 16
+
+def user_bucket(uid):
+    return format(int(hashlib.sha1(uid.encode("utf-8")).hexdigest()[:8], 16) % USER_BUCKETS, "x")
+
+class Metrics:
+    """Latenza per route, tempo per fase (lock/load/render/save/app), dimensione documenti, richieste per gruppo di utenti.
+
+    Niente id utente nelle etichette: l'id è l'unica credenziale e le serie crescerebbero
+    con gli utenti. Si conta per USER_BUCKETS gruppi dall'hash dell'id.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}   # (route, method) -> Histogram
+        self.requests = {}  # (route, method, status) -> n
+        self.phases = {}    # (route, phase) -> secondi
+        self.users = {}     # gruppo (hash dell'uid) -> n
+        self.doc_size = Histogram(DOC_SIZE_BUCKETS)
+
+    def observe(self, route, method, status, uid, total, timings, doc_bytes):
+        with self.lock:
+            h = self.latency.get((route, method))
+            if h is None:
+                h = self.latency[(route, method)] = Histogram(LATENCY_BUCKETS)
+            h.observe(total)
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for name, secs in timings.items():
+                self.phases[(route, name)] = self.phases.get((route, name), 0.0) + secs
+            if uid is not None:
+                bucket = user_bucket(uid)
+                self.users[bucket] = self.users.get(bucket, 0) + 1
+            if doc_bytes is not None:
+                self.doc_size.observe(doc_bytes)
+
+    def render(self):
+        out = []
+        with self.lock:
+            out += ["# HELP fitness_request_duration_seconds Durata delle richieste per route.",
+                    "# TYPE fitness_request_duration_seconds histogram"]
+            for (route, method), h in sorted(self.latency.items()):
+                out += h.lines("fitness_request_duration_seconds", f'route="{route}",method="{method}"')
+            out += ["# HELP fitness_requests_total Richieste per route e status.",
+                    "# TYPE fitness_requests_total counter"]
+            for (route, method, status), n in sorted(self.requests.items()):
+                out.append(f'fitness_requests_total{{route="{route}",method="{method}",status="{status}"}} {n}')
+            out += ["# HELP fitness_request_phase_seconds_total Tempo per fase (lock, load, render, save, app).",
+                    "# TYPE fitness_request_phase_seconds_total counter"]
+            for (route, name), secs in sorted(self.phases.items()):
+                out.append(f'fitness_request_phase_seconds_total{{route="{route}",phase="{name}"}} {secs}')
+            out += ["# HELP fitness_user_requests_total Richieste per gruppo di utenti (hash dell'id).",
+                    "# TYPE fitness_user_requests_total counter"]
+            for bucket, n in sorted(self.users.items()):
+                out.append(f'fitness_user_requests_total{{user_bucket="{bucket}"}} {n}')
+            out += ["# HELP fitness_document_bytes Dimensione del data.json letto dalla richiesta.",
+                    "# TYPE fitness_document_bytes histogram"]
+            out += self.doc_size.lines("fitness_document_bytes", "")
+        behind = getattr(STORE, "behind", None)
+        if behind is not None:
+            out += ["# HELP fitness_write_behind_pending Utenti con modifiche non ancora scritte su disco.",
+                    "# TYPE fitness_write_behind_pending gauge",
+                    f"fitness_write_behind_pending {len(behind.pending)}",
+                    "# HELP fitness_write_behind_saves_total Salvataggi ricevuti in write-behind.",
+                    "# TYPE fitness_write_behind_saves_total counter",
+                    f"fitness_write_behind_saves_total {behind.saves}",
+                    "# HELP fitness_write_behind_flushes_total Scritture su disco fatte dal flush.",
+                    "# TYPE fitness_write_behind_flushes_total counter",
+                    f"fitness_write_behind_flushes_total {behind.flushes}"]
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+class phase:
+    """Somma il tempo del blocco alla fase `name` della richiesta corrente (fuori richiesta non fa nulla)."""
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        timings = g.get("timings") if has_request_context() else None
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + time.perf_counter() - self.t0
+        return False
+
+def note_doc_size(size):
+    if has_request_context() and "timings" in g:
+        g.doc_bytes = size
+
+@app.before_request
+def start_timing():
+    if METRICS_ENABLED:
+        g.t0 = time.perf_counter()
+        g.timings = {}
+
+@before_render_template.connect_via(app)
+def _render_start(sender, **extra):
+    if "timings" in g:
+        g.render_t0 = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _render_end(sender, **extra):
+    if "render_t0" in g:
+        g.timings["render"] = g.timings.get("render", 0.0) + time.perf_counter() - g.pop("render_t0")
+
+@app.after_request
+def record_timing(resp):
+    if "timings" not in g:
+        return resp
+    total = time.perf_counter() - g.t0
+    timings = g.timings
+    timings["app"] = max(0.0, total - sum(timings.values()))
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    uid = get_current_user() if request.endpoint not in (None, "static", "metrics") else None
+    METRICS.observe(route, request.method, resp.status_code, uid, total, timings, g.get("doc_bytes"))
+    if SERVER_TIMING:
+        parts = [f"{name};dur={secs * 1000:.1f}" for name, secs in timings.items()]
+        resp.headers["Server-Timing"] = ", ".join(parts + [f"total;dur={total * 1000:.1f}"])
+    return resp
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return "metriche disattivate (METRICS_ENABLED=0)\n", 404
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            return "token mancante o errato\n", 401
+    elif request.remote_addr not in ("127.0.0.1", "::1"):
+        return "metriche solo da localhost (o con METRICS_TOKEN)\n", 403
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# ===================== PROFILER (su richiesta) =====================
+# Ogni richiesta profilata produce in PROFILE_DIR:
+#   <nome>.prof       pstats di cProfile (snakeviz, python -m pstats)
+#   <nome>.collapsed  stack campionati, formato flamegraph.pl / speedscope
+#   <nome>.json       route, utente, status, durata
+_profile_lock = threading.Lock()  # un profilo alla volta: cProfile non regge più profiler attivi
+
+class StackSampler(threading.Thread):
+    """Campiona lo stack di un thread ogni `interval` secondi e conta gli stack collassati."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+def profile_requested():
+    # senza token chiunque potrebbe profilare e scaricare i profili (route, utenti, tempi)
+    if not (PROFILE_ENABLED and PROFILE_TOKEN):
+        return False
+    token = request.args.get("_profile") or request.headers.get("X-Profile") or ""
+    return hmac.compare_digest(token, PROFILE_TOKEN)
+
+if PROFILE_ENABLED and not PROFILE_TOKEN:
+    app.logger.warning("PROFILE_ENABLED=1 senza PROFILE_TOKEN: profiler disattivato")
+
+@app.before_request
+def start_profile():
+    if request.endpoint in ("profiles_index", "profile_file") or not profile_requested():
+        return
+    if not _profile_lock.acquire(blocking=False):
+        return  # c'è già una richiesta profilata in corso
+    prof = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_MS / 1000)
+    g.profile = (prof, sampler, time.perf_counter())
+    sampler.start()
+    prof.enable()
+
+def _stop_profile():
+    prof, sampler, t0 = g.pop("profile")
+    try:
+        prof.disable()
+        sampler.stop()
+    finally:
+        _profile_lock.release()
+    return prof, sampler.stacks, time.perf_counter() - t0
+
+@app.after_request
+def finish_profile(resp):
+    if "profile" not in g:
+        return resp
+    prof, stacks, elapsed = _stop_profile()
+    resp.headers["X-Profile"] = save_profile(prof, stacks, resp.status_code, elapsed)
+    return resp
+
+@app.teardown_request
+def abort_profile(exc):
+    if "profile" in g:
+        _stop_profile()
+
+def save_profile(prof, stacks, status, elapsed):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    now = datetime.datetime.now()
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    uid = get_current_user()
+    slug = re.sub(r"[^a-zA-Z0-9]+", "-", route).strip("-") or "root"
+    name = f"{now:%Y%m%d-%H%M%S-%f}_{uid}_{slug}"
+    base = os.path.join(PROFILE_DIR, name)
+    prof.dump_stats(base + ".prof")
+    with open(base + ".collapsed", "w", encoding="utf-8") as f:
+        for stack, n in sorted(stacks.items()):
+            f.write(f"{stack} {n}\n")
+    # senza _profile: il token non deve finire nei metadati mostrati in /_profiles
+    query = urlencode([(k, v) for k, v in request.args.items(multi=True) if k != "_profile"])
+    meta = {"name": name, "created": now.isoformat(timespec="seconds"), "route": route,
+            "path": request.path + ("?" + query if query else ""), "method": request.method, "user": uid,
+            "status": status, "ms": round(elapsed * 1000, 1), "samples": sum(stacks.values())}
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    prune_profiles()
+    return name
+
+def list_profiles():
+    try:
+        names = sorted((n[:-5] for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name + ".json"), encoding="utf-8") as f:
+                out.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return out
+
+def prune_profiles():
+    for meta in list_profiles()[PROFILE_KEEP:]:
+        for ext in (".json", ".prof", ".collapsed"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, meta["name"] + ext))
+            except FileNotFoundError:
+                pass
+
+@app.route("/_profiles")
+def profiles_index():
+    if not profile_requested():
+        return "profiler non attivo\n", 404
+    route, user = request.args.get("route"), request.args.get("user")
+    profiles = [p for p in list_profiles()
+                if (not route or p["route"] == route) and (not user or p["user"] == user)]
+    return render_template("profiles.html", uid=get_current_user(), profiles=profiles[:100],
+                           route=route, user=user, token=request.args.get("_profile", ""))
+
+@app.route("/_profiles/<path:filename>")
+def profile_file(filename):
+    if not profile_requested():
+        return "profiler non attivo\n", 404
+    return send_from_directory(PROFILE_DIR, filename, as_attachment=True)
+
+# ===================== CACHE HTTP (ETag) =====================
+# L'ETag dipende dal codice (APP_VERSION o hash di app.py + template), dall'utente,
+# dalla versione dei suoi dati, dal giorno corrente (le pagine senza ?date= usano oggi)
+# e da path + query: se il browser ce l'ha già si risponde 304 senza leggere nulla.
+def _code_version():
+    h = hashlib.sha1()
+    root = os.path.dirname(os.path.abspath(__file__))
+    tpl_dir = os.path.join(root, "templates")
+    for path in [os.path.join(root, "app.py")] + sorted(os.path.join(tpl_dir, n) for n in os.listdir(tpl_dir)):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+APP_VERSION = os.environ.get("APP_VERSION") or _code_version()
+
+def data_version(uid):
+    """Versione dei dati letta una volta per richiesta, prima di caricare il documento."""
+    if g.get("data_version") is None or g.data_version[0] != uid:
+        g.data_version = (uid, STORE.version(uid))
+    return g.data_version[1]
+
+def data_etag(uid):
+    args = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)) if k != "_profile")
+    key = f"{APP_VERSION}|{uid}|{data_version(uid)}|{datetime.date.today().isoformat()}|{request.path}?{args}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:24]
+
+def conditional_get(view):
+    """GET con If-None-Match uguale all'ETag corrente -> 304 prima di caricare o renderizzare."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET" or "profile" in g:
+            return view(*args, **kwargs)
+        # la versione si legge prima dei dati: se cambia in mezzo l'ETag è solo vecchio, mai sbagliato
+        etag = data_etag(get_current_user())
+        if request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+        else:
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+    return wrapper
+
+# ===================== CACHE FRAMMENTI (template) =====================
+# Blocchi pesanti dei template, in un template:
+#   {% call fragment("last_days", ref_date) %} ... {% endcall %}
+# Chiave: utente + nome + parametri; valido finché la versione dei dati non cambia.
+# Stesso LRU a byte dei documenti (il "stamp" è la versione dei dati).
+FRAGMENTS = DocCache(FRAGMENT_CACHE_BYTES) if FRAGMENT_CACHE_BYTES else None
+
+def fragment(name, *params, caller):
+    if FRAGMENTS is None or g.get("data_version") is None:
+        return caller()
+    uid, version = g.data_version
+    key = (uid, name) + params
+    html = FRAGMENTS.get(key, version)
+    if html is None:
+        html = str(caller())
+        FRAGMENTS.put(key, version, len(html.encode("utf-8")), html)
+    return Markup(html)
+
+app.jinja_env.globals["fragment"] = fragment
+
 # ===================== DATE & HELPER =====================
 def parse_date(date_str):
     try:
@@ -171,34 +1938,241 @@ EXERCISE_LIBRARY = {
         {"esercizio":"Lat machine presa supina (3x12-10-8)"}]
 }
 
-# ===================== AGGREGATI & STATS =====================
-def integratori_aggregate(data, ref_date, scope="daily"):
-    items = data.get("giornaliero", [])
-    ref = parse_date(ref_date) if isinstance(ref_date, str) else ref_date
-
-    def in_scope(dt: datetime.date):
-        if scope == "daily":
-            return dt == ref
-        if scope == "weekly":
-            return dt.isocalendar()[:2] == ref.isocalendar()[:2]
-        if scope == "monthly":
-            return dt.year == ref.year and dt.month == ref.month
-        return dt == ref
+# ===================== CATALOGO ALIMENTI =====================
+# Il CSV (valori per 100 g) viene compilato una volta in FOODS_INDEX, che ogni worker
+# apre in mmap: le pagine sono condivise dal sistema operativo, niente parsing all'avvio.
+# Ricerca: prefisso di ogni parola del nome, con bisect sui token ordinati; con più parole
+# si intersecano gli alimenti dei loro intervalli. Gli id seguono la lunghezza del nome:
+# fra gli alimenti trovati si tengono i FOOD_SCAN_LIMIT con id più basso (i nomi più corti),
+# poi prima quelli il cui nome inizia con la ricerca.
+FOOD_CSV_COLUMNS = {  # campo -> intestazioni accettate
+    "name": ("name", "nome", "alimento", "descrizione"),
+    "kcal": ("kcal", "energia_kcal", "calorie"),
+    "prot": ("prot", "proteine", "protein", "proteine_g"),
+    "carb": ("carb", "carbo", "carboidrati", "carbs", "carboidrati_g"),
+    "fat": ("fat", "grassi", "lipidi", "grassi_g"),
+}
+FOOD_INDEX_MAGIC = b"FOODIDX1"
+FOOD_SCAN_LIMIT = 200  # risultati raccolti al massimo per query, prima dell'ordinamento
+
+def food_key(text):
+    """Minuscolo, senza accenti, solo lettere/cifre separate da spazi."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+def read_foods_csv(path):
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        sample = f.read(4096); f.seek(0)
+        reader = csv.DictReader(f, dialect=csv.Sniffer().sniff(sample, delimiters=",;\t"))
+        header = {h.strip().lower(): h for h in reader.fieldnames or []}
+        cols = {}
+        for field, names in FOOD_CSV_COLUMNS.items():
+            found = next((header[n] for n in names if n in header), None)
+            if found is None:
+                raise ValueError(f"{path}: manca la colonna {field} ({' / '.join(names)})")
+            cols[field] = found
+        for row in reader:
+            name = (row.get(cols["name"]) or "").strip()
+            if name:
+                yield name, [sum_float((row.get(cols[k]) or "").replace(",", ".")) for k in ("kcal", "prot", "carb", "fat")]
+
+def build_food_index(csv_path, out_path):
+    """CSV -> file indice: header, offset nomi/chiavi/token, macro float32, token->alimento, testi."""
+    foods = sorted(((food_key(name), name, vals) for name, vals in read_foods_csv(csv_path)),
+                   key=lambda f: (len(f[1]), f[0]))
+    names, keys, macros, tokens = [], [], array.array("f"), []
+    for i, (key, name, vals) in enumerate(foods):
+        names.append(name.encode("utf-8"))
+        keys.append(key.encode("utf-8"))
+        macros.extend(vals)
+        tokens.extend((t.encode("utf-8"), i) for t in set(key.split()))
+    tokens.sort()
+
+    def offsets(blobs):
+        off, pos = array.array("I", [0]), 0
+        for b in blobs:
+            pos += len(b); off.append(pos)
+        return off
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(FOOD_INDEX_MAGIC + struct.pack("=II", len(names), len(tokens)))
+        f.write(offsets(names).tobytes())
+        f.write(offsets(keys).tobytes())
+        f.write(macros.tobytes())
+        f.write(offsets([t for t, _ in tokens]).tobytes())
+        f.write(array.array("I", [i for _, i in tokens]).tobytes())
+        f.write(b"".join(names))
+        f.write(b"".join(keys))
+        f.write(b"".join(t for t, _ in tokens))
+    os.replace(tmp_path, out_path)
+    return len(names)
+
+class FoodIndex:
+    """Vista in sola lettura (mmap) su un file creato da build_food_index."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != FOOD_INDEX_MAGIC:
+            raise ValueError(f"{path}: non è un indice alimenti")
+        self.n_foods, self.n_tokens = struct.unpack_from("=II", self.mm, 8)
+        view, pos = memoryview(self.mm), 16
+
+        def take(fmt, count):
+            nonlocal pos
+            size = struct.calcsize(fmt) * count
+            part = view[pos:pos + size].cast(fmt)
+            pos += size
+            return part
+        self.name_off = take("I", self.n_foods + 1)
+        self.key_off = take("I", self.n_foods + 1)
+        self.macros = take("f", self.n_foods * 4)
+        self.tok_off = take("I", self.n_tokens + 1)
+        self.tok_food = take("I", self.n_tokens)
+        self.names_at = pos
+        self.keys_at = self.names_at + self.name_off[self.n_foods]
+        self.tokens_at = self.keys_at + self.key_off[self.n_foods]
+
+    def name(self, i):
+        return self.mm[self.names_at + self.name_off[i]:self.names_at + self.name_off[i + 1]].decode("utf-8")
+
+    def key(self, i):
+        return self.mm[self.keys_at + self.key_off[i]:self.keys_at + self.key_off[i + 1]].decode("ascii")
+
+    def token(self, i):
+        return self.mm[self.tokens_at + self.tok_off[i]:self.tokens_at + self.tok_off[i + 1]]
+
+    def food(self, i):
+        kcal, prot, carb, fat = (round(v, 1) for v in self.macros[4 * i:4 * i + 4])
+        return {"id": i, "name": self.name(i), "base": 100, "unit": "g",
+                "kcal_base": kcal, "prot_base": prot, "carb_base": carb, "fat_base": fat}
+
+    def _lower_bound(self, key):
+        lo, hi = 0, self.n_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.token(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix):
+        p = prefix.encode("utf-8")
+        return self._lower_bound(p), self._lower_bound(p + b"\xff")
+
+    def search(self, query, limit=10):
+        words = food_key(query).split()
+        if not words:
+            return []
+        ranges = sorted((self.prefix_range(w) for w in set(words)), key=lambda r: r[1] - r[0])
+        # alimenti che hanno ogni parola come prefisso, a partire dalla più selettiva
+        lo, hi = ranges[0]
+        ids = set(self.tok_food[lo:hi])
+        for lo, hi in ranges[1:]:
+            if not ids:
+                break
+            ids.intersection_update(self.tok_food[lo:hi])
+        # un prefisso copre più token, ognuno con i suoi id: si ordina per id (= nome più corto) prima del limite
+        q = " ".join(words)
+        ranked = sorted((not self.key(i).startswith(q), i) for i in heapq.nsmallest(FOOD_SCAN_LIMIT, ids))
+        return [self.food(i) for _, i in ranked[:limit]]
+
+_food_index = None
+_food_index_loaded = False
+_food_index_lock = threading.Lock()
+
+def food_index():
+    """Indice del catalogo (None se non c'è né FOODS_INDEX né FOODS_CSV); ricompilato se il CSV è più nuovo."""
+    global _food_index, _food_index_loaded
+    with _food_index_lock:
+        if not _food_index_loaded:
+            _food_index_loaded = True  # un solo tentativo per processo, anche se fallisce
+            try:
+                if os.path.exists(FOODS_CSV) and (not os.path.exists(FOODS_INDEX)
+                                                  or os.path.getmtime(FOODS_INDEX) < os.path.getmtime(FOODS_CSV)):
+                    build_food_index(FOODS_CSV, FOODS_INDEX)
+                if os.path.exists(FOODS_INDEX):
+                    _food_index = FoodIndex(FOODS_INDEX)
+            except (OSError, ValueError, csv.Error):
+                app.logger.exception("catalogo alimenti non disponibile")
+        return _food_index
+
+@app.cli.command("build-food-index")
+@click.argument("csv_path", default=None, required=False)
+def build_food_index_command(csv_path):
+    """Compila il CSV degli alimenti (default FOODS_CSV) in FOODS_INDEX, da aprire in mmap."""
+    t0 = time.perf_counter()
+    n = build_food_index(csv_path or FOODS_CSV, FOODS_INDEX)
+    click.echo(f"{n} alimenti indicizzati in {FOODS_INDEX} ({time.perf_counter() - t0:.1f}s)")
 
-    tot = {"creatina_g":0.0,"preworkout_pill":0.0,"termogenico_pill":0.0,"proteine_g":0.0}
+# ===================== AGGREGATI & STATS =====================
+# (chiave aggregato, campo in giornaliero)
+INTEGRATORI_FIELDS = (
+    ("creatina_g", "q_creatina_g"),
+    ("preworkout_pill", "q_preworkout_pill"),
+    ("termogenico_pill", "q_termogenico_pill"),
+    ("proteine_g", "q_proteine_g"),
+)
+
+def scope_key(dt: datetime.date, scope="daily"):
+    """Chiave del bucket (giorno / settimana ISO / mese) a cui appartiene una data."""
+    if scope == "weekly":
+        return tuple(dt.isocalendar()[:2])
+    if scope == "monthly":
+        return (dt.year, dt.month)
+    return dt
+
+def build_integratori_rollup(items):
+    """Un solo passaggio su giornaliero: totali integratori per giorno, settimana ISO e mese."""
+    rollup = {"daily": {}, "weekly": {}, "monthly": {}}
     for r in items:
         try:
             dt = datetime.date.fromisoformat(r.get("data","1900-01-01"))
         except Exception:
             continue
-        if not in_scope(dt):
-            continue
-        tot["creatina_g"]      += sum_float(r.get("q_creatina_g",0))
-        tot["preworkout_pill"] += sum_float(r.get("q_preworkout_pill",0))
-        tot["termogenico_pill"]+= sum_float(r.get("q_termogenico_pill",0))
-        tot["proteine_g"]      += sum_float(r.get("q_proteine_g",0))
-    for k in tot: tot[k] = round(tot[k],2)
-    return tot
+        vals = [sum_float(r.get(field, 0)) for _, field in INTEGRATORI_FIELDS]
+        for scope, bucket in rollup.items():
+            tot = bucket.setdefault(scope_key(dt, scope), [0.0] * len(vals))
+            for i, v in enumerate(vals):
+                tot[i] += v
+    return rollup
+
+def scope_bounds(ref, scope="daily"):
+    """Primo e ultimo giorno del periodo (giorno / settimana ISO / mese) che contiene ref."""
+    if scope == "weekly":
+        start = ref - datetime.timedelta(days=ref.weekday())
+        return start, start + datetime.timedelta(days=6)
+    if scope == "monthly":
+        start = ref.replace(day=1)
+        nxt = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start, nxt - datetime.timedelta(days=1)
+    return ref, ref
+
+def rollup_lookup(rollup, ref, scope="daily"):
+    if scope not in ("daily", "weekly", "monthly"):
+        scope = "daily"
+    tot = rollup[scope].get(scope_key(ref, scope))
+    if tot is None:
+        return {k: 0.0 for k, _ in INTEGRATORI_FIELDS}
+    return {k: round(tot[i], 2) for i, (k, _) in enumerate(INTEGRATORI_FIELDS)}
+
+def rollup_last_days(rollup, ref, days=30):
+    out = []
+    for i in range(0, days):
+        d = ref - datetime.timedelta(days=i)
+        s = rollup_lookup(rollup, d, "daily")
+        s.update({"data": d.isoformat()})
+        out.append(s)
+    return out
+
+def integratori_aggregate(data, ref_date, scope="daily", rollup=None):
+    ref = parse_date(ref_date) if isinstance(ref_date, str) else ref_date
+    if rollup is None:
+        rollup = build_integratori_rollup(data.get("giornaliero", []))
+    return rollup_lookup(rollup, ref, scope)
 
 def _first_int(s):
     if not s: return 0
@@ -206,53 +2180,688 @@ def _first_int(s):
     return int(m.group()) if m else 0
 
 def _float_or_zero(x):
-    try: return float(x)
+    try: v = float(x)
     except: return 0.0
+    return v if math.isfinite(v) and v >= 0 else 0.0
 
-def parse_set_details(s):
-    if not s: return 0, 0.0
-    total_reps, volume = 0, 0.0
+def valid_set(reps, load):
+    return math.isfinite(reps) and math.isfinite(load) and reps >= 0 and load >= 0
+
+def split_sets(s):
+    """"10@40, 8@45" -> ([(10.0, 40.0), (8.0, 45.0)], token non validi)."""
+    sets, bad = [], []
+    if not s: return sets, bad
     for token in str(s).split(","):
         token = token.strip().replace("@ ", "@")
-        if "@" in token:
-            reps_str, load_str = token.split("@", 1)
-            try:
-                reps = float(reps_str.strip())
-                load = float(load_str.strip())
-                total_reps += int(reps)
-                volume += reps * load
-            except:
-                continue
-    return total_reps, round(volume,2)
+        if not token:
+            continue
+        reps_str, sep, load_str = token.partition("@")
+        try:
+            if not sep:
+                raise ValueError(token)
+            reps, load = float(reps_str.strip()), float(load_str.strip())
+            if not valid_set(reps, load):
+                raise ValueError(token)  # inf/nan/negativi finirebbero nel JSON e nei grafici
+            sets.append((reps, load))
+        except ValueError:
+            bad.append(token)
+    return sets, bad
+
+def parse_sets(s):
+    return split_sets(s)[0]
+
+def _num(x):
+    return int(x) if float(x).is_integer() else x
+
+# Forma strutturata di un esercizio, calcolata una volta al salvataggio accanto al testo:
+# "sets": [{"reps", "load"}] effettivi (dal dettaglio o serie × ripetizioni @ carico),
+# "n_serie", "n_rip", "kg" numerici, "set_scartati" con i token non leggibili.
+EXERCISE_DERIVED = ("sets", "n_serie", "n_rip", "kg", "set_scartati")  # scritti da normalize_exercise
+
+def normalize_exercise(e):
+    setdet = e.get("set_dettagli")
+    n_serie, n_rip = _first_int(e.get("serie")), _first_int(e.get("ripetizioni"))
+    kg = _float_or_zero(e.get("carico"))
+    if setdet:
+        sets, bad = split_sets(setdet)
+    else:
+        sets, bad = ([(n_rip, kg)] * n_serie if n_serie and n_rip and kg else []), []
+    e.update(sets=[{"reps": _num(r), "load": _num(l)} for r, l in sets],
+             n_serie=n_serie, n_rip=n_rip, kg=_num(kg))
+    if bad:
+        e["set_scartati"] = bad
+    else:
+        e.pop("set_scartati", None)
+    return e
+
+def normalize_session(s):
+    """Normalizza in place gli esercizi della sessione; ritorna i token scartati."""
+    bad = []
+    for e in s.get("ex") or []:
+        bad += normalize_exercise(e).get("set_scartati", [])
+    return bad
+
+def is_normalized(s):
+    # i set non validi salvati prima del controllo in split_sets si rinormalizzano con migrate-sets
+    return all("sets" in e and all(valid_set(x["reps"], x["load"]) for x in e["sets"])
+               for e in s.get("ex") or [])
+
+def exercise_sets(e):
+    """Set (rep, kg) di un esercizio: dalla forma strutturata; le sessioni non migrate si leggono dal testo."""
+    if "sets" not in e:
+        e = normalize_exercise(dict(e))
+    return [(x["reps"], x["load"]) for x in e["sets"]]
+
+def session_stats(s):
+    """(esercizi fatti, volume serie×rep×kg) di una singola sessione."""
+    done = 0; vol = 0.0
+    for e in s.get("ex") or []:
+        if e.get("fatto"): done += 1
+        vol += round(sum(r * l for r, l in exercise_sets(e)), 2)
+    return done, vol
+
+# Rollup materializzato salvato nel documento: {"days": {data: [ex_done, volume]}}.
+# allenamenti() lo aggiorna a ogni sessione, l'import lo ricostruisce.
+TRAINING_ROLLUP = "training_rollup"
+EXERCISE_INDEX = "exercise_index"
+DERIVED_KEYS = {TRAINING_ROLLUP, EXERCISE_INDEX, COLD_SEGMENTS}
+
+def rollup_add_session(rollup, s):
+    d = s.get("data")
+    if not d: return
+    done, vol = session_stats(s)
+    cur = rollup["days"].setdefault(d, [0, 0.0])
+    cur[0] += done
+    cur[1] += vol
+
+def build_training_rollup(sessions):
+    rollup = {"days": {}}
+    for s in sessions:
+        rollup_add_session(rollup, s)
+    return rollup
+
+def training_series(rollup):
+    days = rollup.get("days", {})
+    return [{"data":d,"ex_done":days[d][0],"volume":round(days[d][1],1)} for d in sorted(days)]
 
 def compute_training_stats(sessions):
-    stats = {}
+    return training_series(build_training_rollup(sessions))
+
+def training_rollup(tx):
+    """Rollup della transazione (in scrittura); se manca lo ricostruisce dalle sessioni."""
+    rollup = tx.get_section(TRAINING_ROLLUP)
+    if "days" not in rollup:
+        rollup = build_training_rollup(tx.range("allenamenti"))
+        tx.put_section(TRAINING_ROLLUP, rollup)
+    return rollup
+
+def user_training_rollup(uid):
+    with transaction(uid, write=False) as tx:
+        rollup = tx.get_section(TRAINING_ROLLUP)
+    if "days" not in rollup:
+        with transaction(uid) as tx:
+            rollup = training_rollup(tx)
+    return rollup
+
+# Indice per esercizio salvato nel documento:
+# {"ex": {nome: {"log": [[data, carico max, volume miglior set, 1RM stimato, [[rep, kg], ...]], ...],
+#                "pr": {"load": [kg, data], "set_volume": [...], "e1rm": [...]}}}}
+# Il log è ordinato per data; aggiornato come il rollup allenamenti.
+PR_FIELDS = ("load", "set_volume", "e1rm")
+
+def estimate_1rm(reps, load):
+    """Massimale stimato (Epley)."""
+    return load if reps <= 1 else load * (1 + reps / 30.0)
+
+def exercise_index_add_session(index, s):
+    d = s.get("data")
+    if not d: return
+    for e in s.get("ex") or []:
+        name = (e.get("esercizio") or "").strip()
+        sets = [(r, l) for r, l in exercise_sets(e) if r > 0 and l > 0]
+        if not name or not sets:
+            continue
+        top = max(l for _, l in sets)
+        best_set = max(r * l for r, l in sets)
+        e1rm = max(estimate_1rm(r, l) for r, l in sets)
+        entry = [d, top, round(best_set, 1), round(e1rm, 1), [[r, l] for r, l in sets]]
+        ex = index["ex"].setdefault(name, {"log": [], "pr": {}})
+        log = ex["log"]
+        if log and log[-1][0] > d:
+            log.insert(bisect.bisect_right(log, d, key=itemgetter(0)), entry)
+        else:
+            log.append(entry)
+        for field, val in zip(PR_FIELDS, entry[1:4]):
+            best = ex["pr"].get(field)
+            if best is None or val > best[0]:
+                ex["pr"][field] = [val, d]
+
+def build_exercise_index(sessions):
+    index = {"ex": {}}
     for s in sessions:
-        d = s.get("data")
-        if not d: continue
-        ex_list = s.get("ex") or []
-        done = 0; vol = 0.0
-        for e in ex_list:
-            if e.get("fatto"): done += 1
-            setdet = e.get("set_dettagli")
-            if setdet:
-                _, v = parse_set_details(setdet)
-                vol += v
-            else:
-                serie = _first_int(e.get("serie"))
-                reps  = _first_int(e.get("ripetizioni"))
-                load  = _float_or_zero(e.get("carico"))
-                if serie and reps and load:
-                    vol += serie * reps * load
-        cur = stats.get(d, {"ex_done":0,"volume":0.0})
-        cur["ex_done"] += done
-        cur["volume"] += vol
-        stats[d] = cur
-    out = []
-    for d in sorted(stats.keys()):
-        out.append({"data":d,"ex_done":stats[d]["ex_done"],"volume":round(stats[d]["volume"],1)})
+        exercise_index_add_session(index, s)
+    return index
+
+def exercise_index(tx):
+    """Indice esercizi della transazione (in scrittura); se manca lo ricostruisce dalle sessioni."""
+    index = tx.get_section(EXERCISE_INDEX)
+    if "ex" not in index:
+        index = build_exercise_index(tx.range("allenamenti"))
+        tx.put_section(EXERCISE_INDEX, index)
+    return index
+
+def user_exercise_index(uid):
+    with transaction(uid, write=False) as tx:
+        index = tx.get_section(EXERCISE_INDEX)
+    if "ex" not in index:
+        with transaction(uid) as tx:
+            index = exercise_index(tx)
+    return index
+
+def _fmt_num(x):
+    return f"{x:g}"
+
+def exercise_history(index, names, before=None):
+    """Per ogni nome: ultima sessione (prima di `before`, se dato) e record personali."""
+    out = {}
+    for name in names:
+        ex = index.get("ex", {}).get(name)
+        if not ex or not ex["log"]:
+            continue
+        log = ex["log"]
+        i = bisect.bisect_left(log, before, key=itemgetter(0)) if before else len(log)
+        last = log[i - 1] if i else None
+        out[name] = {
+            "last": last and {"data": last[0], "load": last[1], "e1rm": last[3],
+                              "sets": ", ".join(f"{_fmt_num(r)}@{_fmt_num(l)}" for r, l in last[4])},
+            "pr": {field: {"value": v, "data": d} for field, (v, d) in ex["pr"].items()},
+        }
+    return out
+
+# ===================== SERIE TEMPORALI (grafici) =====================
+# metrica -> (sorgente, campo)
+SERIES_METRICS = {
+    "peso": ("giornaliero", "peso"),
+    "vita": ("giornaliero", "vita"),
+    "fianchi": ("giornaliero", "fianchi"),
+    "volume": (TRAINING_ROLLUP, 1),
+    "ex_done": (TRAINING_ROLLUP, 0),
+}
+SERIES_DEFAULT_POINTS = 400
+SERIES_MAX_POINTS = 5000
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets: riduce [(x, y, ...), ...] a `threshold` punti mantenendo la forma."""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+    out = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        nxt_start, nxt_end = end, min(int((i + 2) * every) + 1, n)
+        if nxt_end <= nxt_start:
+            nxt_end = nxt_start + 1
+        nxt = points[nxt_start:nxt_end]
+        avg_x = sum(p[0] for p in nxt) / len(nxt)
+        avg_y = sum(p[1] for p in nxt) / len(nxt)
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(points[best])
+        a = best
+    out.append(points[-1])
     return out
 
+def series_points(rows, field, date_from=None, date_to=None):
+    """[(ordinale, valore, data)] ordinati per data, solo righe con un valore numerico."""
+    pts = []
+    for r in rows:
+        dstr = r.get("data")
+        try:
+            d = datetime.date.fromisoformat(dstr)
+            v = float(r.get(field))
+        except Exception:
+            continue
+        if (date_from and d < date_from) or (date_to and d > date_to):
+            continue
+        pts.append((d.toordinal(), v, dstr))
+    pts.sort(key=lambda p: p[0])
+    return pts
+
+def rollup_points(rollup, idx, date_from=None, date_to=None):
+    rows = [{"data": d, "v": round(vals[idx], 1)} for d, vals in rollup.get("days", {}).items()]
+    return series_points(rows, "v", date_from, date_to)
+
+# ===================== ANALISI TREND (numpy) =====================
+# Serie giornaliere dense (un elemento per giorno, NaN se manca il dato) dal primo
+# all'ultimo giorno registrato: medie mobili, ritmo settimanale, regressione
+# kcal -> variazione di peso e data stimata per il peso obiettivo.
+TREND_FIELDS = (("giornaliero", "peso"), ("giornaliero", "vita"), ("giornaliero", "fianchi"), ("alimentazione", "kcal"))
+TREND_RATE_DAYS = 28       # finestra della retta per il ritmo kg/settimana
+TREND_MAX_ETA_DAYS = 5 * 365
+
+def dense_series(values, start, n):
+    """[(data ISO, valore)] -> array di n giorni da `start` (giorni epoch), NaN dove manca; vince l'ultimo del giorno."""
+    arr = np.full(n, np.nan)
+    if values:
+        days = np.array([d for d, _ in values], dtype="datetime64[D]").astype(np.int64) - start
+        arr[days] = np.array([v for _, v in values], dtype=float)
+    arr[arr <= 0] = np.nan
+    return arr
+
+def rolling_mean(arr, window):
+    """Media dei valori presenti negli ultimi `window` giorni (NaN se nessuno)."""
+    valid = ~np.isnan(arr)
+    cs = np.concatenate(([0.0], np.cumsum(np.where(valid, arr, 0.0))))
+    cn = np.concatenate(([0], np.cumsum(valid)))
+    hi = np.arange(1, len(arr) + 1)
+    lo = np.maximum(hi - window, 0)
+    counts = cn[hi] - cn[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, (cs[hi] - cs[lo]) / counts, np.nan)
+
+@functools.lru_cache(maxsize=64)
+def trend_arrays(uid, version):
+    """Serie dense e medie mobili dell'utente; la cache vale per una versione dei dati."""
+    with transaction(uid, write=False) as tx:
+        values = {field: tx.values_between(coll, field) for coll, field in TREND_FIELDS}
+    dates = [d for vals in values.values() for d, _ in vals]
+    if not dates:
+        return None
+    first = np.datetime64(min(dates), "D")
+    n = int((np.datetime64(max(dates), "D") - first).astype(np.int64)) + 1
+    start = first.astype(np.int64)
+    out = {"start": datetime.date.fromisoformat(min(dates)), "n": n}
+    for field, vals in values.items():
+        arr = dense_series(vals, start, n)
+        out[field] = arr
+        out[field + "_7"] = rolling_mean(arr, 7)
+        out[field + "_28"] = rolling_mean(arr, 28)
+    return out
+
+def _last_finite(arr, upto):
+    idx = np.flatnonzero(~np.isnan(arr[:upto + 1]))
+    return float(arr[idx[-1]]) if len(idx) else None
+
+def trend_summary(arrays, ref, target=None):
+    """Valori al giorno `ref` (o all'ultimo giorno registrato, se precedente)."""
+    t = min((ref - arrays["start"]).days, arrays["n"] - 1)
+    if t < 0:
+        return None
+    out = {"as_of": (arrays["start"] + datetime.timedelta(days=t)).isoformat()}
+    for field in ("peso", "vita", "fianchi", "kcal"):
+        for w in (7, 28):
+            v = _last_finite(arrays[f"{field}_{w}"], t)
+            out[f"{field}_{w}"] = round(v, 1) if v is not None else None
+
+    # ritmo: pendenza della retta sulle pesate degli ultimi TREND_RATE_DAYS giorni
+    peso = arrays["peso"][max(0, t - TREND_RATE_DAYS + 1):t + 1]
+    x = np.flatnonzero(~np.isnan(peso))
+    rate = float(np.polyfit(x, peso[x], 1)[0] * 7) if len(x) >= 4 and x[-1] > x[0] else None
+    out["rate_week"] = round(rate, 2) if rate is not None else None
+
+    # kcal medie di una settimana -> variazione della media peso nella stessa settimana
+    w7, k7 = arrays["peso_7"][:t + 1], arrays["kcal_7"][:t + 1]
+    dw = w7[7:] - w7[:-7]
+    kc = k7[7:]
+    ok = ~np.isnan(dw) & ~np.isnan(kc)
+    out.update(kcal_slope=None, maintenance_kcal=None, kcal_r=None, kcal_points=int(ok.sum()))
+    if ok.sum() >= 14 and np.ptp(kc[ok]) > 0:
+        slope, intercept = np.polyfit(kc[ok], dw[ok], 1)
+        out["kcal_slope"] = round(float(slope) * 100, 3)  # kg/settimana ogni 100 kcal
+        out["kcal_r"] = round(float(np.corrcoef(kc[ok], dw[ok])[0, 1]), 2)
+        if slope > 0:
+            out["maintenance_kcal"] = round(float(-intercept / slope))
+
+    # data stimata per il peso obiettivo, al ritmo attuale
+    out.update(eta=None, eta_weeks=None, reached=False)
+    current = out["peso_7"]
+    if target is not None and current is not None:
+        diff = float(target) - current
+        if abs(diff) < 0.1:
+            out["reached"] = True
+        elif rate and (diff > 0) == (rate > 0):
+            weeks = diff / rate
+            if weeks * 7 <= TREND_MAX_ETA_DAYS:
+                out["eta_weeks"] = round(weeks, 1)
+                out["eta"] = (ref + datetime.timedelta(days=round(weeks * 7))).isoformat()
+    return out
+
+def user_trends(uid, ref, goals):
+    """Trend dell'utente al giorno `ref`; None senza numpy o senza dati."""
+    if np is None:
+        return None
+    version = data_version(uid) if has_request_context() else STORE.version(uid)
+    arrays = trend_arrays(uid, version)
+    if arrays is None:
+        return None
+    return trend_summary(arrays, ref, goals.get("weight_target"))
+
+# ===================== EXPORT (streaming) =====================
+EXPORT_FORMATS = {
+    "json": ("application/json", "json"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+# colonne fisse per il CSV (i campi annidati finiscono come JSON nella cella)
+CSV_COLUMNS = {
+    "giornaliero": ["data","creatina","preworkout","termogenico","proteine",
+                    "q_creatina_g","q_preworkout_pill","q_termogenico_pill","q_proteine_g",
+                    "peso","vita","fianchi","note"],
+    "allenamenti": ["data","giorno","completion","preworkout","proteine_post","creatina_post",
+                    "q_preworkout_pill","q_proteine_post_g","q_creatina_post_g","misure","foto","ex"],
+    "alimentazione": ["data","plan_type","kcal_target","kcal","proteine_g","carbo_g","grassi_g","completion",
+                      "creatina_mattino","termogenico_mattino","proteine_pasto",
+                      "q_creatina_mattino_g","q_termogenico_mattino_pill","q_proteine_pasto_g","note","meals"],
+}
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def _export_parts(tx, fmt, collections, date_from, date_to):
+    wanted = collections or list(COLLECTIONS) + [k for k in tx.section_names() if k not in DERIVED_KEYS]
+    dumps = lambda v: json.dumps(v, ensure_ascii=False)
+    if fmt == "csv":
+        coll = wanted[0]
+        cols = CSV_COLUMNS[coll]
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(cols)
+        for r in tx.iter_range(coll, date_from, date_to):
+            writer.writerow([dumps(r.get(c)) if isinstance(r.get(c), (dict, list)) else r.get(c, "") for c in cols])
+            yield line.getvalue()
+            line.seek(0); line.truncate()
+        yield line.getvalue()
+        return
+    if fmt == "ndjson":
+        for name in wanted:
+            if name in COLLECTIONS:
+                for r in tx.iter_range(name, date_from, date_to):
+                    yield dumps({"collection": name, "record": r}) + "\n"
+            else:
+                yield dumps({"collection": name, "record": tx.get_section(name)}) + "\n"
+        return
+    yield "{"
+    for i, name in enumerate(wanted):
+        yield ("," if i else "") + "\n" + dumps(name) + ": "
+        if name in COLLECTIONS:
+            yield "["
+            for j, r in enumerate(tx.iter_range(name, date_from, date_to)):
+                yield ("," if j else "") + "\n  " + dumps(r)
+            yield "\n]"
+        else:
+            yield dumps(tx.get_section(name))
+    yield "\n}\n"
+
+def export_chunks(uid, fmt="json", collections=None, date_from=None, date_to=None):
+    """Export dell'utente a pezzi da ~64 KB, record per record: mai l'intero documento in una stringa."""
+    with transaction(uid, write=False) as tx:
+        buf, size = [], 0
+        for part in _export_parts(tx, fmt, collections, date_from, date_to):
+            buf.append(part); size += len(part)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield "".join(buf)
+                buf, size = [], 0
+        if buf:
+            yield "".join(buf)
+
+def gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> formato gzip
+    for c in chunks:
+        out = z.compress(c.encode("utf-8"))
+        if out:
+            yield out
+    yield z.flush()
+
+# ===================== IMPORT (streaming, con deduplica) =====================
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+IMPORT_READ_SIZE = 64 * 1024
+
+def open_upload(raw):
+    """Stream di testo sull'upload (binario, seekable), decompresso se è un .gz."""
+    head = raw.read(2)
+    raw.seek(0)
+    if head == b"\x1f\x8b":
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+def iter_json_document(fp, prefix=""):
+    """Legge un export JSON {"chiave": [record, ...], ...} restituendo (chiave, record) uno alla volta.
+
+    Le collezioni vengono lette elemento per elemento con raw_decode su un buffer,
+    quindi in memoria c'è al massimo un blocco di lettura più un record.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos = prefix, 0
+
+    def more():
+        nonlocal buf, pos
+        chunk = fp.read(IMPORT_READ_SIZE)
+        buf, pos = buf[pos:] + chunk, 0
+        return bool(chunk)
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                return ""
+
+    def expect(ch):
+        nonlocal pos
+        if peek() != ch:
+            raise ValueError(f"JSON non valido: atteso {ch!r}")
+        pos += 1
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                val, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not more():
+                    raise
+                continue
+            if end == len(buf) and more():  # un numero a fine buffer potrebbe continuare
+                continue
+            pos = end
+            return val
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key in COLLECTIONS and peek() == "[":
+            expect("[")
+            if peek() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield key, value()
+                    if peek() != ",":
+                        break
+                    pos += 1
+                expect("]")
+        else:
+            yield key, value()
+        if peek() != ",":
+            break
+        pos += 1
+    expect("}")
+
+def iter_import_records(fp):
+    """(collezione, record) da un export JSON o NDJSON (una riga {"collection", "record"} per record)."""
+    first = fp.readline(IMPORT_READ_SIZE)
+    if not first.lstrip().startswith('{"collection"'):
+        yield from iter_json_document(fp, prefix=first)
+        return
+    if not first.endswith("\n"):
+        first += fp.readline()  # prima riga più lunga di IMPORT_READ_SIZE
+    for line in itertools.chain([first], fp):
+        if line.strip():
+            obj = json.loads(line)
+            yield obj["collection"], obj["record"]
+
+def record_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def session_hash(s):
+    """Hash di una sessione senza i campi derivati da normalize_session: migrata o no, stesso valore."""
+    ex = [{k: v for k, v in e.items() if k not in EXERCISE_DERIVED} for e in s.get("ex") or []]
+    return record_hash({**s, "ex": ex})
+
+# liste annidate nei record: devono contenere solo oggetti
+NESTED_LISTS = {"allenamenti": "ex", "alimentazione": "meals"}
+
+def valid_import_record(name, rec):
+    """Forma minima di un record importato: quello che le route leggono senza controlli."""
+    if not isinstance(rec, dict) or not isinstance(rec.get("data"), str):
+        return False
+    try:
+        datetime.date.fromisoformat(rec["data"])
+    except ValueError:
+        return False
+    items = rec.get(NESTED_LISTS.get(name), [])
+    if not isinstance(items, list) or not all(isinstance(x, dict) for x in items):
+        return False
+    return name != "allenamenti" or all(isinstance(e.get("esercizio", ""), str) for e in items)
+
+def _import_batch(tx, batch, report):
+    rollup = None
+    for name, rec in batch:
+        if name in DERIVED_KEYS:
+            continue
+        counts = report.setdefault(name, {"inserted": 0, "updated": 0, "skipped": 0})
+        if name in COLLECTIONS:
+            if not valid_import_record(name, rec):
+                counts["skipped"] += 1
+            elif name == "allenamenti":
+                normalize_session(rec)
+                # più sessioni nello stesso giorno sono legittime: chiave = data + hash del contenuto
+                h = session_hash(rec)
+                if any(session_hash(s) == h for s in tx.records_on(name, rec["data"])):
+                    counts["skipped"] += 1
+                else:
+                    if rollup is None:
+                        rollup, index = training_rollup(tx), exercise_index(tx)
+                    tx.append(name, rec)
+                    rollup_add_session(rollup, rec)
+                    exercise_index_add_session(index, rec)
+                    counts["inserted"] += 1
+            else:
+                cur = tx.get_day(name, rec["data"])
+                if cur is None:
+                    tx.append(name, rec)
+                    counts["inserted"] += 1
+                elif cur == rec:
+                    counts["skipped"] += 1
+                else:
+                    tx.put_day(name, rec)
+                    counts["updated"] += 1
+        elif not isinstance(rec, dict):
+            counts["skipped"] += 1  # le sezioni sono oggetti (goals.get(...) nelle route)
+        else:
+            cur = tx.get_section(name)
+            new = {**cur, **rec} if name in SECTIONS else rec
+            if new == cur:
+                counts["skipped"] += 1
+            else:
+                tx.put_section(name, new)
+                counts["updated"] += 1
+    if rollup is not None:
+        tx.put_section(TRAINING_ROLLUP, rollup)
+        tx.put_section(EXERCISE_INDEX, index)
+
+def import_records(uid, items, batch_size=None):
+    """Upsert di (collezione, record) a blocchi, una transazione per blocco. Ritorna i conteggi per collezione."""
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report, batch = {}, []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            with transaction(uid) as tx:
+                _import_batch(tx, batch, report)
+            batch = []
+    if batch:
+        with transaction(uid) as tx:
+            _import_batch(tx, batch, report)
+    return report
+
+def import_totals(report):
+    return {k: sum(c[k] for c in report.values()) for k in ("inserted", "updated", "skipped")}
+
+# ===================== REPORT SETTIMANALI (batch) =====================
+REPORT_COLUMNS = ["user", "week", "week_start", "week_end",
+                  "sessions", "completion_avg", "ex_done", "volume",
+                  "meal_days", "kcal_avg", "kcal_target_avg", "kcal_adherence_pct", "days_in_target",
+                  *(k for k, _ in INTEGRATORI_FIELDS)]
+KCAL_TOLERANCE = 0.10  # giorno "in target" se entro ±10% delle kcal previste
+
+def weekly_summary(tx, week_start):
+    """Riassunto di una settimana ISO (da lunedì) per l'utente della transazione."""
+    week_end = week_start + datetime.timedelta(days=6)
+    a, b = week_start.isoformat(), week_end.isoformat()
+    sessions = tx.range("allenamenti", a, b)
+    meals = tx.range("alimentazione", a, b)
+    goals, meal_plan = tx.get_section("goals"), tx.get_section("meal_plan")
+    stats = compute_training_stats(sessions)
+
+    kcal, targets, in_target = [], [], 0
+    for m in meals:
+        try:
+            wd = datetime.date.fromisoformat(m.get("data")).strftime("%A")
+        except Exception:
+            continue
+        target = sum_float(goals.get("kcal_training") if meal_plan.get(wd, "rest") == "training" else goals.get("kcal_rest"))
+        k = sum_float(m.get("kcal"))
+        kcal.append(k); targets.append(target)
+        if target and abs(k - target) <= KCAL_TOLERANCE * target:
+            in_target += 1
+    kcal_avg = sum(kcal) / len(kcal) if kcal else 0.0
+    target_avg = sum(targets) / len(targets) if targets else 0.0
+
+    row = {
+        "week": "%d-W%02d" % tuple(week_start.isocalendar()[:2]),
+        "week_start": a, "week_end": b,
+        "sessions": len(sessions),
+        "completion_avg": round(sum(sum_float(s.get("completion")) for s in sessions) / len(sessions), 1) if sessions else 0.0,
+        "ex_done": sum(d["ex_done"] for d in stats),
+        "volume": round(sum(d["volume"] for d in stats), 1),
+        "meal_days": len(meals),
+        "kcal_avg": round(kcal_avg, 0),
+        "kcal_target_avg": round(target_avg, 0),
+        "kcal_adherence_pct": round(100 * kcal_avg / target_avg, 1) if target_avg else 0.0,
+        "days_in_target": in_target,
+    }
+    giornaliero = tx.range("giornaliero", a, b)
+    row.update(integratori_aggregate(None, week_start, "weekly", rollup=build_integratori_rollup(giornaliero)))
+    return row
+
+def _report_worker_init():
+    # dopo il fork: niente connessioni SQLite condivise con il processo padre
+    if isinstance(STORE, SqliteStore):
+        STORE._local = threading.local()
+    REGISTRY._local = threading.local()
+
+def report_user(job):
+    """Eseguita nei processi del pool: (uid, righe, errore)."""
+    uid, weeks = job
+    try:
+        with transaction(uid, write=False) as tx:
+            return uid, [{"user": uid, **weekly_summary(tx, w)} for w in weeks], None
+    except Exception as e:
+        return uid, [], f"{type(e).__name__}: {e}"
+
 # ===================== ROUTES: USER / EXPORT / IMPORT / UPLOADS =====================
 @app.route("/switch_user", methods=["POST"])
 def switch_user():
@@ -262,12 +2871,35 @@ def switch_user():
     return resp
 
 @app.route("/export", methods=["GET"])
+@conditional_get
 def export_user_data():
     uid = get_current_user()
-    data = load_data(uid)
-    buf = io.BytesIO(json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
-    fname = f"{uid}_fitness_export.json"
-    return send_file(buf, mimetype="application/json", as_attachment=True, download_name=fname)
+    fmt = request.args.get("format") or "json"
+    collections = request.args.getlist("collection")
+    compress = request.args.get("gzip") in ("1", "true", "yes")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"formato sconosciuto: {fmt}"}), 400
+    if any(c not in COLLECTIONS + SECTIONS for c in collections):
+        return jsonify({"error": "collezione sconosciuta"}), 400
+    if fmt == "csv" and (len(collections) != 1 or collections[0] not in CSV_COLUMNS):
+        return jsonify({"error": "il CSV richiede una sola collection=giornaliero|allenamenti|alimentazione"}), 400
+    try:
+        date_from = datetime.date.fromisoformat(request.args["from"]).isoformat() if request.args.get("from") else None
+        date_to = datetime.date.fromisoformat(request.args["to"]).isoformat() if request.args.get("to") else None
+    except ValueError:
+        return jsonify({"error": "parametri from/to non validi"}), 400
+
+    chunks = export_chunks(uid, fmt, collections or None, date_from, date_to)
+    mimetype, ext = EXPORT_FORMATS[fmt]
+    fname = f"{uid}_fitness_export.{ext}"
+    if compress:
+        chunks = gzip_chunks(chunks)
+        mimetype, fname = "application/gzip", fname + ".gz"
+    else:
+        chunks = (c.encode("utf-8") for c in chunks)
+    resp = app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{fname}"'
+    return resp
 
 @app.route("/import", methods=["POST"])
 def import_user_data():
@@ -276,24 +2908,39 @@ def import_user_data():
     if not up:
         return redirect(url_for("diario", u=uid))
     try:
-        payload = json.load(up.stream)
-    except Exception:
-        return redirect(url_for("diario", u=uid))
-    cur = load_data(uid)
-    for key, val in payload.items():
-        if key in {"giornaliero","allenamenti","alimentazione"} and isinstance(val, list):
-            cur.setdefault(key, []); cur[key].extend(val)
-        elif key in {"meal_plan","goals"} and isinstance(val, dict):
-            cur.setdefault(key, {}); cur[key].update(val)
-        else:
-            cur[key] = val
-    save_data(cur, uid)
-    return redirect(url_for("diario", u=uid))
+        report = import_records(uid, iter_import_records(open_upload(up.stream)))
+    except (ValueError, KeyError, TypeError, OSError, EOFError) as e:
+        error = f"{type(e).__name__}: {e}"[:200]
+        app.logger.warning("import %s fallito: %s", uid, error)
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({"error": error}), 400
+        return redirect(url_for("diario", u=uid, import_error=error))
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(report)
+    tot = import_totals(report)
+    return redirect(url_for("diario", u=uid, imported=f"{tot['inserted']}/{tot['updated']}/{tot['skipped']}"))
 
 @app.route("/user_uploads/<user_id>/<path:filename>")
 def user_uploads(user_id, filename):
     _, up_dir = user_dirs(sanitize_user_id(user_id))
-    return send_from_directory(up_dir, filename)
+    folder, _, name = filename.rpartition("/")
+    digest = name.rsplit(".", 1)[0]
+    if folder not in ("", THUMBS_SUBDIR) or not PHOTO_HASH_RE.fullmatch(digest):
+        return send_from_directory(up_dir, filename)  # foto caricate prima degli hash
+    if folder and not os.path.exists(os.path.join(up_dir, filename)):
+        # anteprima non ancora pronta: la si accoda e intanto si serve l'originale
+        orig = next((f"{digest}.{ext}" for ext in sorted(ALLOWED_IMG)
+                     if os.path.exists(os.path.join(up_dir, f"{digest}.{ext}"))), None)
+        if orig is None:
+            abort(404)
+        queue_thumb(up_dir, orig)
+        resp = send_from_directory(up_dir, orig)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+    # il nome è l'hash del contenuto: il file non cambia mai
+    resp = send_from_directory(up_dir, filename, etag=digest + ("-thumb" if folder else ""), max_age=31536000)
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
 
 # ===================== ROUTES PRINCIPALI =====================
 @app.route("/")
@@ -302,67 +2949,37 @@ def index():
 
 # --------- DIARIO ---------
 @app.route("/diario", methods=["GET"])
+@conditional_get
 def diario():
     uid = get_current_user()
-    data = load_data(uid)
-
     ref_date = get_date_from_request()
     scope = request.args.get("scope") or "daily"
+    scope_start, scope_end = scope_bounds(ref_date, scope)
+    # finestra di giornaliero che copre sia il periodo scelto sia gli ultimi 30 giorni
+    window_start = min(scope_start, ref_date - datetime.timedelta(days=29))
+    window_end = max(scope_end, ref_date)
+
+    with transaction(uid, write=False) as tx:
+        giornaliero = tx.range("giornaliero", window_start.isoformat(), window_end.isoformat())
+        alim_records = tx.records_on("alimentazione", ref_date.isoformat())
+        goals = tx.get_section("goals")
+        cur_weight = goals.get("peso_attuale", None)
+        if cur_weight is None:
+            cur_weight = tx.latest_float("giornaliero", "peso", on_or_before=ref_date)
+        if cur_weight is None:
+            cur_weight = tx.latest_float("giornaliero", "peso")
+        photos = tx.photos_between(scope_start.isoformat(), scope_end.isoformat())
+        measures = tx.measures_between(scope_start.isoformat(), scope_end.isoformat())
+
+    rollup = build_integratori_rollup(giornaliero)
+    agg = integratori_aggregate(None, ref_date, scope, rollup=rollup)
+
+    last_days = rollup_last_days(rollup, ref_date, 30)
+
+    measures_latest = measures[-1] if measures else None
 
-    agg = integratori_aggregate(data, ref_date, scope)
-
-    def in_scope(dt: datetime.date):
-        if scope == "daily":
-            return dt == ref_date
-        if scope == "weekly":
-            return dt.isocalendar()[:2] == ref_date.isocalendar()[:2]
-        if scope == "monthly":
-            return dt.year == ref_date.year and dt.month == ref_date.month
-        return dt == ref_date
-
-    last_days = []
-    for i in range(0, 30):
-        d = ref_date - datetime.timedelta(days=i)
-        s = integratori_aggregate(data, d, "daily")
-        s.update({"data": d.isoformat()})
-        last_days.append(s)
-
-    photos = []
-    measures_latest = None
-    for s in data.get("allenamenti", []):
-        dstr = s.get("data")
-        if not dstr: continue
-        try:
-            d = datetime.date.fromisoformat(dstr)
-        except Exception:
-            continue
-        if not in_scope(d): continue
-        if s.get("foto"):
-            photos.append({"data": dstr, "url": s["foto"]})
-        mis = s.get("misure") or {}
-        if any(mis.values()):
-            if (measures_latest is None) or (dstr >= measures_latest.get("data","")):
-                measures_latest = {"data": dstr, **mis}
-
-    goals = data.get("goals", {})
     start_weight = goals.get("weight_start", 61.0)
     target_weight = goals.get("weight_target", 55.0)
-    cur_weight = goals.get("peso_attuale", None)
-    if cur_weight is None:
-        for r in sorted(data.get("giornaliero", []), key=lambda x: x.get("data","")):
-            try:
-                d = datetime.date.fromisoformat(r.get("data","1900-01-01"))
-            except Exception:
-                continue
-            if d <= ref_date and r.get("peso"):
-                try: cur_weight = float(r.get("peso"))
-                except: pass
-    if cur_weight is None:
-        for r in sorted(data.get("giornaliero", []), key=lambda x: x.get("data",""), reverse=True):
-            if r.get("peso"):
-                try:
-                    cur_weight = float(r.get("peso")); break
-                except: continue
 
     try:
         span = max((start_weight - target_weight), 0.0001)
@@ -377,8 +2994,7 @@ def diario():
         "target": round(target_weight, 1),
         "progress_pct": progress_pct
     }
-
-    alim_records = sorted(data.get("alimentazione", []), key=lambda r: r.get("data",""), reverse=True)
+    trends = user_trends(uid, ref_date, goals)
 
     return render_template(
         "diario.html",
@@ -390,18 +3006,18 @@ def diario():
         photos=sorted(photos, key=lambda x: x["data"], reverse=True),
         measures_latest=measures_latest,
         weight_block=weight_block,
+        trends=trends,
         alim_records=alim_records
     )
 
 # --------- ALLENAMENTI (GET/POST) ---------
 @app.route("/allenamenti", methods=["GET","POST"])
+@conditional_get
 def allenamenti():
     uid = get_current_user()
-    data = load_data(uid)
     chosen_date = get_date_from_request()
     wd = weekday_en(chosen_date)
     plan_today = WORKOUT_PLAN.get(wd, [])
-    _, UPLOAD_DIR = user_dirs(uid)
 
     if request.method == "POST":
         prewo = bool(request.form.get("preworkout"))
@@ -419,8 +3035,9 @@ def allenamenti():
         foto_url = ""
         file = request.files.get("foto")
         if file and file.filename and allowed_file(file.filename):
-            fname = werkzeug.utils.secure_filename(f"{chosen_date.isoformat()}_{file.filename}")
-            file.save(os.path.join(UPLOAD_DIR, fname))
+            _, up_dir = user_dirs(uid, create=True)
+            fname = store_photo(file.stream, file.filename.rsplit(".", 1)[1], up_dir)
+            queue_thumb(up_dir, fname)
             foto_url = f"{uploads_url(uid)}/{fname}"
 
         session = {
@@ -497,55 +3114,55 @@ def allenamenti():
             cust_idx += 1
 
         session["completion"] = int(100 * (done_count / selected_count)) if selected_count else 0
-        data["allenamenti"].append(session)
-
-        diary = None
-        for r in data["giornaliero"]:
-            if r.get("data") == chosen_date.isoformat():
-                diary = r; break
-        if diary is None:
-            diary = {"data": chosen_date.isoformat(),
-                     "creatina":False,"preworkout":False,"termogenico":False,"proteine":False,
-                     "q_creatina_g":"","q_preworkout_pill":"","q_termogenico_pill":"","q_proteine_g":"",
-                     "peso":"","vita":"","fianchi":"","note":""}
-            data["giornaliero"].append(diary)
-        if prewo:
-            diary["preworkout"] = True
-            diary["q_preworkout_pill"] = str(sum_float(diary.get("q_preworkout_pill")) + sum_float(q_pre))
-        if protpo:
-            diary["proteine"] = True
-            diary["q_proteine_g"] = str(sum_float(diary.get("q_proteine_g")) + sum_float(q_prot))
-        if creapo:
-            diary["creatina"] = True
-            diary["q_creatina_g"] = str(sum_float(diary.get("q_creatina_g")) + sum_float(q_crea))
-
-        save_data(data, uid)
+        bad = normalize_session(session)
+        if bad:
+            app.logger.info("allenamenti %s %s: set non leggibili %s", uid, session["data"], bad)
+
+        with transaction(uid) as tx:
+            rollup, index = training_rollup(tx), exercise_index(tx)
+            tx.append("allenamenti", session)
+            rollup_add_session(rollup, session)
+            exercise_index_add_session(index, session)
+            tx.put_section(TRAINING_ROLLUP, rollup)
+            tx.put_section(EXERCISE_INDEX, index)
+            diary = diary_day(tx, chosen_date.isoformat())
+            if prewo:
+                diary["preworkout"] = True
+                diary["q_preworkout_pill"] = str(sum_float(diary.get("q_preworkout_pill")) + sum_float(q_pre))
+            if protpo:
+                diary["proteine"] = True
+                diary["q_proteine_g"] = str(sum_float(diary.get("q_proteine_g")) + sum_float(q_prot))
+            if creapo:
+                diary["creatina"] = True
+                diary["q_creatina_g"] = str(sum_float(diary.get("q_creatina_g")) + sum_float(q_crea))
+            tx.put_day("giornaliero", diary)
         return redirect(url_for("allenamenti", u=uid, date=chosen_date.isoformat()))
 
-    records_day = [s for s in data.get("allenamenti", []) if s.get("data") == chosen_date.isoformat()]
+    with transaction(uid, write=False) as tx:
+        records_day = tx.records_on("allenamenti", chosen_date.isoformat())
+    names = [ex["esercizio"] for ex in plan_today] + [it["esercizio"] for items in EXERCISE_LIBRARY.values() for it in items]
+    history = exercise_history(user_exercise_index(uid), names, before=chosen_date.isoformat())
     return render_template("allenamenti.html",
                            uid=uid, plan_today=plan_today, weekday=wd,
-                           exercise_library=EXERCISE_LIBRARY,
+                           exercise_library=EXERCISE_LIBRARY, history=history,
                            records=records_day, chosen_date=chosen_date.isoformat())
 
 # --------- ALIMENTAZIONE ---------
 @app.route("/alimentazione", methods=["GET","POST"])
+@conditional_get
 def alimentazione():
     uid = get_current_user()
-    data = load_data(uid)
     chosen_date = get_date_from_request()
     wd = weekday_en(chosen_date)
-    plan_type = data["meal_plan"].get(wd, "rest")
+    with transaction(uid, write=False) as tx:
+        meal_plan = tx.get_section("meal_plan")
+        goals = tx.get_section("goals")
+        records_day = tx.records_on("alimentazione", chosen_date.isoformat())
+    plan_type = meal_plan.get(wd, "rest")
 
-    goals = data.get("goals", {})
     base_kcal_target = goals.get("kcal_training") if plan_type=="training" else goals.get("kcal_rest")
     plan = DEFAULT_MEAL_PLAN["training" if plan_type=="training" else "rest"]
 
-    existing = None
-    for a in data.get("alimentazione", []):
-        if a.get("data") == chosen_date.isoformat():
-            existing = a; break
-
     if request.method == "POST":
         try:
             kcal_target_day = int(float(request.form.get("kcal_target") or base_kcal_target))
@@ -608,73 +3225,356 @@ def alimentazione():
         m["carbo_g"] = round(carb_tot, 1)
         m["grassi_g"] = round(fat_tot, 1)
 
-        if existing:
-            data["alimentazione"] = [x for x in data["alimentazione"] if x.get("data") != chosen_date.isoformat()]
-        data["alimentazione"].append(m)
-
-        diary = None
-        for r in data["giornaliero"]:
-            if r.get("data") == chosen_date.isoformat():
-                diary = r; break
-        if diary is None:
-            diary = {"data": chosen_date.isoformat(),
-                     "creatina":False,"preworkout":False,"termogenico":False,"proteine":False,
-                     "q_creatina_g":"","q_preworkout_pill":"","q_termogenico_pill":"","q_proteine_g":"",
-                     "peso":"","vita":"","fianchi":"","note":""}
-            data["giornaliero"].append(diary)
-
-        if m["creatina_mattino"]:
-            diary["creatina"] = True
-            diary["q_creatina_g"] = str(sum_float(diary.get("q_creatina_g")) + sum_float(m["q_creatina_mattino_g"]))
-        if m["proteine_pasto"]:
-            diary["proteine"] = True
-            diary["q_proteine_g"] = str(sum_float(diary.get("q_proteine_g")) + sum_float(m["q_proteine_pasto_g"]))
-        if m["termogenico_mattino"]:
-            diary["termogenico"] = True
-            diary["q_termogenico_pill"] = str(sum_float(diary.get("q_termogenico_pill")) + sum_float(m["q_termogenico_mattino_pill"]))
-
-        save_data(data, uid)
+        with transaction(uid) as tx:
+            tx.upsert_day("alimentazione", m)
+
+            diary = diary_day(tx, chosen_date.isoformat())
+            if m["creatina_mattino"]:
+                diary["creatina"] = True
+                diary["q_creatina_g"] = str(sum_float(diary.get("q_creatina_g")) + sum_float(m["q_creatina_mattino_g"]))
+            if m["proteine_pasto"]:
+                diary["proteine"] = True
+                diary["q_proteine_g"] = str(sum_float(diary.get("q_proteine_g")) + sum_float(m["q_proteine_pasto_g"]))
+            if m["termogenico_mattino"]:
+                diary["termogenico"] = True
+                diary["q_termogenico_pill"] = str(sum_float(diary.get("q_termogenico_pill")) + sum_float(m["q_termogenico_mattino_pill"]))
+            tx.put_day("giornaliero", diary)
         return redirect(url_for("alimentazione", u=uid, date=chosen_date.isoformat()))
 
-    records_day = [a for a in data.get("alimentazione", []) if a.get("data") == chosen_date.isoformat()]
     base_kcal_target = base_kcal_target or plan["kcal_target"]
     return render_template("alimentazione.html",
                            uid=uid, plan=plan, plan_type=plan_type,
+                           foods_available=food_index() is not None,
                            plan_kcal_target=base_kcal_target,
                            records=records_day, chosen_date=chosen_date.isoformat())
 
+@app.route("/api/foods")
+def api_foods():
+    index = food_index()
+    if index is None:
+        return jsonify({"q": request.args.get("q", ""), "items": [], "available": False})
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 10), 50))
+    except ValueError:
+        return jsonify({"error": "limit non valido"}), 400
+    q = request.args.get("q", "")
+    return jsonify({"q": q, "items": index.search(q, limit), "available": True})
+
 # --------- PROGRESSI ---------
 @app.route("/progressi")
+@conditional_get
 def progressi():
     uid = get_current_user()
-    data = load_data(uid)
-    diario_records = data.get("giornaliero", [])
+    # i dati arrivano dai grafici via /api/series, solo per il periodo scelto
+    return render_template("progressi.html", uid=uid)
+
+@app.route("/api/series/<metric>")
+@conditional_get
+def api_series(metric):
+    uid = get_current_user()
+    if metric not in SERIES_METRICS:
+        return jsonify({"error": f"metrica sconosciuta: {metric}"}), 404
     try:
-        diario_records = sorted(diario_records, key=lambda r: r["data"])
-    except Exception:
-        pass
-    training_stats = compute_training_stats(data.get("allenamenti", []))
-    return render_template("progressi.html", uid=uid, records=diario_records, training_stats=training_stats)
+        date_from = datetime.date.fromisoformat(request.args["from"]) if request.args.get("from") else None
+        date_to = datetime.date.fromisoformat(request.args["to"]) if request.args.get("to") else None
+        points = int(request.args.get("points") or SERIES_DEFAULT_POINTS)
+    except ValueError:
+        return jsonify({"error": "parametri from/to/points non validi"}), 400
+    points = max(3, min(points, SERIES_MAX_POINTS))
+
+    source, field = SERIES_METRICS[metric]
+    if source == TRAINING_ROLLUP:
+        pts = rollup_points(user_training_rollup(uid), field, date_from, date_to)
+    else:
+        with transaction(uid, write=False) as tx:
+            values = tx.values_between(source, field, date_from and date_from.isoformat(), date_to and date_to.isoformat())
+        pts = [(datetime.date.fromisoformat(d).toordinal(), v, d) for d, v in values]
+
+    sampled = lttb(pts, points)
+    return jsonify({
+        "metric": metric,
+        "from": date_from and date_from.isoformat(),
+        "to": date_to and date_to.isoformat(),
+        "total": len(pts),
+        "points": [[p[2], p[1]] for p in sampled],
+    })
 
 # --------- OBIETTIVI ---------
 @app.route("/obiettivi", methods=["GET","POST"])
+@conditional_get
 def obiettivi():
     uid = get_current_user()
-    data = load_data(uid)
-    goals = data.get("goals", {})
     if request.method == "POST":
-        goals["kcal_training"] = float(request.form.get("kcal_training") or goals.get("kcal_training", 1700))
-        goals["kcal_rest"]     = float(request.form.get("kcal_rest") or goals.get("kcal_rest", 1500))
-        goals["weight_start"]  = float(request.form.get("weight_start") or goals.get("weight_start", 61.0))
-        goals["weight_target"] = float(request.form.get("weight_target") or goals.get("weight_target", 55.0))
-        w_curr = request.form.get("peso_attuale")
-        if w_curr:
-            try: goals["peso_attuale"] = float(w_curr)
-            except: pass
-        data["goals"] = goals
-        save_data(data, uid)
+        with transaction(uid) as tx:
+            goals = tx.get_section("goals")
+            goals["kcal_training"] = float(request.form.get("kcal_training") or goals.get("kcal_training", 1700))
+            goals["kcal_rest"]     = float(request.form.get("kcal_rest") or goals.get("kcal_rest", 1500))
+            goals["weight_start"]  = float(request.form.get("weight_start") or goals.get("weight_start", 61.0))
+            goals["weight_target"] = float(request.form.get("weight_target") or goals.get("weight_target", 55.0))
+            w_curr = request.form.get("peso_attuale")
+            if w_curr:
+                try: goals["peso_attuale"] = float(w_curr)
+                except: pass
+            tx.put_section("goals", goals)
         return redirect(url_for("obiettivi", u=uid))
-    return render_template("obiettivi.html", uid=uid, goals=goals)
+    with transaction(uid, write=False) as tx:
+        goals = tx.get_section("goals")
+    trends = user_trends(uid, datetime.date.today(), goals)
+    return render_template("obiettivi.html", uid=uid, goals=goals, trends=trends)
+
+@app.cli.command("export-all")
+@click.argument("archive")
+@click.option("--format", "fmt", type=click.Choice(["json", "ndjson"]), default="ndjson")
+@click.option("--gzip", "compress", is_flag=True, help="Comprime ogni utente (.gz) dentro l'archivio.")
+def export_all_command(archive, fmt, compress):
+    """Esporta tutti gli utenti in un archivio tar; se interrotto riparte dall'ultimo utente completato."""
+    ckpt_path = archive + ".checkpoint"
+    done, offset = set(), 0
+    if os.path.exists(archive) and os.path.exists(ckpt_path):
+        with open(ckpt_path, encoding="utf-8") as f:
+            for line in f:
+                uid, end = line.rstrip("\n").rsplit("\t", 1)
+                done.add(uid); offset = int(end)
+        # scarta l'eventuale membro scritto a metà e richiude l'archivio con i blocchi finali
+        with open(archive, "r+b") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(b"\0" * tarfile.BLOCKSIZE * 2)
+    elif os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+
+    exported = 0
+    with tarfile.open(archive, "a" if done else "w") as tar, open(ckpt_path, "a", encoding="utf-8") as ckpt:
+        for uid in STORE.user_ids():
+            if uid in done:
+                continue
+            chunks = export_chunks(uid, fmt)
+            chunks = gzip_chunks(chunks) if compress else (c.encode("utf-8") for c in chunks)
+            with tempfile.TemporaryFile() as tmp:
+                for c in chunks:
+                    tmp.write(c)
+                info = tarfile.TarInfo(f"{uid}.{EXPORT_FORMATS[fmt][1]}" + (".gz" if compress else ""))
+                info.size = tmp.tell()
+                info.mtime = int(time.time())
+                tmp.seek(0)
+                tar.addfile(info, tmp)
+            tar.fileobj.flush()
+            ckpt.write(f"{uid}\t{tar.offset}\n")
+            ckpt.flush()
+            exported += 1
+            click.echo(f"{uid}: ok")
+    click.echo(f"Esportati {exported} utenti in {archive} ({len(done)} già presenti)")
+
+@app.cli.command("weekly-report")
+@click.argument("output")
+@click.option("--week", help="Ultima settimana del report, es. 2024-W05 (default: l'ultima conclusa).")
+@click.option("--weeks", default=1, show_default=True, help="Quante settimane, a ritroso da --week.")
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default="csv", show_default=True)
+@click.option("--workers", type=int, default=os.cpu_count() or 1, show_default=True)
+@click.option("--chunksize", default=16, show_default=True, help="Utenti per invio a ciascun worker.")
+def weekly_report_command(output, week, weeks, fmt, workers, chunksize):
+    """Riassunti settimanali di tutti gli utenti in un unico CSV/NDJSON, in parallelo; se interrotto riprende."""
+    if week:
+        m = re.fullmatch(r"(\d{4})-?W(\d{1,2})", week)
+        if m is None:
+            raise click.BadParameter("formato atteso AAAA-Wss, es. 2024-W05", param_hint="--week")
+        last = datetime.date.fromisocalendar(int(m.group(1)), int(m.group(2)), 1)
+    else:
+        today = datetime.date.today()
+        last = today - datetime.timedelta(days=today.weekday() + 7)
+    week_starts = [last - datetime.timedelta(weeks=i) for i in reversed(range(weeks))]
+
+    # checkpoint: "uid\toffset" dopo ogni utente scritto, come export-all
+    ckpt_path = output + ".checkpoint"
+    done, offset = set(), 0
+    if os.path.exists(output) and os.path.exists(ckpt_path):
+        with open(ckpt_path, encoding="utf-8") as f:
+            for line in f:
+                uid, end = line.rstrip("\n").rsplit("\t", 1)
+                done.add(uid); offset = int(end)
+        with open(output, "r+b") as f:
+            f.truncate(offset)
+    elif os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+
+    todo = [uid for uid in STORE.user_ids() if uid not in done]
+    errors = []
+    with open(output, "a" if done else "w", encoding="utf-8", newline="") as out, \
+            open(ckpt_path, "a", encoding="utf-8") as ckpt, \
+            multiprocessing.Pool(max(1, workers), initializer=_report_worker_init) as pool, \
+            click.progressbar(length=len(todo), label=f"{len(todo)} utenti", file=sys.stderr) as bar:
+        writer = csv.DictWriter(out, fieldnames=REPORT_COLUMNS) if fmt == "csv" else None
+        if writer and not done:
+            writer.writeheader()
+        jobs = ((uid, week_starts) for uid in todo)
+        for uid, rows, err in pool.imap_unordered(report_user, jobs, chunksize=max(1, chunksize)):
+            bar.update(1)
+            if err:
+                errors.append((uid, err))  # niente checkpoint: alla ripresa si riprova
+                continue
+            for row in rows:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            out.flush()
+            ckpt.write(f"{uid}\t{out.tell()}\n")
+            ckpt.flush()
+    for uid, err in errors:
+        click.echo(f"{uid}: errore {err}", err=True)
+    click.echo(f"Report di {len(todo) - len(errors)} utenti in {output} ({len(done)} già presenti, {len(errors)} errori)")
+
+@app.cli.command("import-file")
+@click.argument("user_id")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_file_command(user_id, path):
+    """Importa un export (JSON/NDJSON, anche .gz) nell'utente indicato, senza duplicare i record."""
+    with open(path, "rb") as raw:
+        report = import_records(sanitize_user_id(user_id), iter_import_records(open_upload(raw)))
+    for name, counts in sorted(report.items()):
+        click.echo(f"{name}: {counts['inserted']} nuovi, {counts['updated']} aggiornati, {counts['skipped']} saltati")
+
+@app.cli.command("tier-data")
+@click.option("--days", type=int, default=None, help="Orizzonte in giorni (default COLD_AFTER_DAYS).")
+def tier_data_command(days):
+    """Archivia nei segmenti freddi i mesi interi più vecchi dell'orizzonte (backend JSON)."""
+    if STORAGE_BACKEND != "json":
+        raise click.ClickException("tier-data serve solo con STORAGE_BACKEND=json: SQLite legge già per intervallo di date")
+    horizon = (datetime.date.today() - datetime.timedelta(days=COLD_AFTER_DAYS if days is None else days)).isoformat()
+    total = 0
+    for uid in STORE.user_ids():
+        with transaction(uid) as tx:
+            n = tx.archive(horizon)
+            segments = len(tx.get_section(COLD_SEGMENTS))
+        total += n
+        if n:
+            click.echo(f"{uid}: {n} record archiviati ({segments} segmenti)")
+    click.echo(f"Record archiviati: {total} (mesi prima di {horizon[:7]})")
+
+@app.cli.command("migrate-sets")
+@click.option("--check", is_flag=True, help="Conta soltanto le sessioni da migrare.")
+def migrate_sets_command(check):
+    """Aggiunge la forma strutturata dei set alle sessioni salvate prima della normalizzazione."""
+    total = 0
+    for uid in STORE.user_ids():
+        bad = []
+        def migrate(s):
+            if is_normalized(s):
+                return False
+            bad.extend(normalize_session(s))
+            return True
+        with transaction(uid, write=not check) as tx:
+            if check:
+                n = sum(1 for s in tx.iter_range("allenamenti") if not is_normalized(s))
+            else:
+                n = tx.update_records("allenamenti", migrate)
+        total += n
+        if n:
+            click.echo(f"{uid}: {n} sessioni" + (" da migrare" if check else " migrate")
+                       + (f", {len(bad)} set non leggibili" if bad else ""))
+    click.echo(f"Sessioni {'da migrare' if check else 'migrate'}: {total}")
+
+@app.cli.command("migrate-layout")
+def migrate_layout_command():
+    """Sposta le cartelle utente da users/<uid> a users/<ab>/<cd>/<uid> e ricostruisce il registro (app ferma)."""
+    staging = os.path.join(USERS_DIR, ".legacy")
+    shard = re.compile(r"[0-9a-f]{2}")
+    # prima tutte da parte: un utente può chiamarsi come un livello di shard (es. "ab"), e allora
+    # la sua cartella contiene anche gli utenti già sharded: si spostano solo i suoi file
+    for name in os.listdir(USERS_DIR):
+        path = os.path.join(USERS_DIR, name)
+        if not name.startswith(".") and os.path.isdir(path) and is_legacy_user_dir(path):
+            os.makedirs(os.path.join(staging, name), exist_ok=True)
+            for entry in os.listdir(path):
+                if not (shard.fullmatch(entry) and os.path.isdir(os.path.join(path, entry))):
+                    os.rename(os.path.join(path, entry), os.path.join(staging, name, entry))
+            if not os.listdir(path):
+                os.rmdir(path)
+    moved = 0
+    for uid in sorted(os.listdir(staging)) if os.path.isdir(staging) else []:
+        dst = sharded_base(uid)
+        if os.path.exists(dst):
+            raise click.ClickException(f"{uid}: {dst} esiste già, la cartella resta in {staging}")
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.rename(os.path.join(staging, uid), dst)
+        moved += 1
+    if os.path.isdir(staging):
+        os.rmdir(staging)
+    click.echo(f"Cartelle spostate: {moved}; utenti nel registro: {JsonStore().rebuild_registry()}")
+
+@app.cli.command("list-users")
+@click.option("--sort", "order", type=click.Choice(sorted(UserRegistry.ORDER)), default="recent", show_default=True)
+@click.option("--limit", type=int, default=None)
+def list_users_command(order, limit):
+    """Utenti del registro con dimensione e ultimo salvataggio (backend JSON)."""
+    for uid, size, mtime in REGISTRY.rows(order, limit):
+        stamp = datetime.datetime.fromtimestamp(mtime).isoformat(timespec="seconds")
+        click.echo(f"{uid}\t{size // 1024} KB\t{stamp}")
+
+@app.cli.command("migrate-photos")
+def migrate_photos_command():
+    """Rinomina per contenuto le foto caricate prima degli hash e genera le anteprime mancanti."""
+    for uid in STORE.user_ids():
+        _, up_dir = user_dirs(uid)
+        prefix = uploads_url(uid) + "/"
+        renamed = {}
+        def migrate(s):
+            name = (s.get("foto") or "").removeprefix(prefix)
+            if name == s.get("foto") or "/" in name or thumb_name(name):
+                return False
+            if name not in renamed:
+                src = os.path.join(up_dir, name)
+                if not (allowed_file(name) and os.path.exists(src)):
+                    return False
+                with open(src, "rb") as f:
+                    renamed[name] = store_photo(f, name.rsplit(".", 1)[1], up_dir)
+            s["foto"] = prefix + renamed[name]
+            return True
+        with transaction(uid) as tx:
+            n = tx.update_records("allenamenti", migrate)
+        for old in renamed:
+            os.remove(os.path.join(up_dir, old))
+        thumbs = 0
+        for name in (os.listdir(up_dir) if Image is not None and os.path.isdir(up_dir) else []):
+            thumb = thumb_name(name)
+            if thumb and not os.path.exists(os.path.join(up_dir, thumb)):
+                os.makedirs(os.path.join(up_dir, THUMBS_SUBDIR), exist_ok=True)
+                make_thumb(os.path.join(up_dir, name), os.path.join(up_dir, thumb))
+                thumbs += 1
+        if n or thumbs:
+            click.echo(f"{uid}: {n} sessioni aggiornate, {len(renamed)} file rinominati, {thumbs} anteprime")
+
+@app.cli.command("rebuild-training-rollup")
+@click.option("--check", is_flag=True, help="Confronta soltanto, senza riscrivere i rollup.")
+def rebuild_training_rollup_command(check):
+    """Ricalcola rollup allenamenti e indice esercizi di ogni utente dalle sessioni e segnala le differenze."""
+    mismatches = missing = 0
+    for uid in STORE.user_ids():
+        with transaction(uid, write=not check) as tx:
+            sessions = tx.range("allenamenti")
+            # (nome, chiave presente quando è costruito, ricalcolato, confronto)
+            sections = (
+                ("rollup allenamenti", TRAINING_ROLLUP, "days", build_training_rollup(sessions),
+                 lambda a, b: training_series(a) == training_series(b)),
+                ("indice esercizi", EXERCISE_INDEX, "ex", build_exercise_index(sessions),
+                 lambda a, b: a == b),
+            )
+            differs = False
+            for label, key, marker, fresh, same in sections:
+                stored = tx.get_section(key)
+                if marker not in stored:
+                    # si costruisce al primo uso: non è una differenza
+                    missing += 1
+                    click.echo(f"{uid}: {label} non costruito" + ("" if check else " (costruito)"))
+                elif same(stored, fresh):
+                    continue
+                else:
+                    differs = True
+                    click.echo(f"{uid}: {label} diverso dalle sessioni" + ("" if check else " (ricostruito)"))
+                if not check:
+                    tx.put_section(key, fresh)
+            mismatches += differs
+    click.echo(f"Utenti con differenze: {mismatches}; sezioni non ancora costruite: {missing}")
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,152 @@
+"""Generatore di dati sintetici per i benchmark: storico di più anni per uno o più utenti.
+
+    python bench/gendata.py --users 3 --years 2 --sessions-per-week 4 --out /tmp/fitness-data
+
+Salva ogni utente con save_data() nella DATA_ROOT <out> (layout e backend come l'app),
+con giornaliero, allenamenti e alimentazione costruiti da WORKOUT_PLAN, EXERCISE_LIBRARY
+e DEFAULT_MEAL_PLAN.
+"""
+import argparse, datetime, os, random, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+def _training_days(sessions_per_week, plan):
+    # prima i giorni del piano, poi (se servono) i giorni liberi con esercizi dalla libreria
+    days = [d for d in WEEKDAYS if d in plan][:sessions_per_week]
+    days += [d for d in WEEKDAYS if d not in days][:max(0, sessions_per_week - len(days))]
+    return set(days)
+
+def _set_details(rnd, serie, load):
+    sets = []
+    for i in range(serie):
+        reps = rnd.choice((8, 10, 10, 12, 12, 15))
+        sets.append(f"{reps}@{round(load + 2.5 * (i == serie - 1), 1)}")
+    return ", ".join(sets)
+
+def _session(rnd, app, day, wd, loads):
+    plan = app.WORKOUT_PLAN.get(wd)
+    if plan is None:
+        _, items = rnd.choice(list(app.EXERCISE_LIBRARY.items()))
+        plan = [{"esercizio": it["esercizio"], "serie": "3", "ripetizioni": "12"} for it in items]
+    ex = []
+    for item in plan:
+        name = item["esercizio"]
+        # carico con progressione lenta nel tempo, diverso per esercizio
+        load = loads.setdefault(name, rnd.choice((10, 20, 30, 40, 60, 80)))
+        loads[name] = round(load * rnd.uniform(0.99, 1.015), 1)
+        serie = app._first_int(item["serie"]) or 3
+        detailed = rnd.random() < 0.6
+        done = rnd.random() < 0.85
+        ex.append({
+            "esercizio": name, "serie": item["serie"], "ripetizioni": item["ripetizioni"],
+            "carico": str(round(load, 1)),
+            "set_dettagli": _set_details(rnd, serie, load) if detailed else "",
+            "difficolta": rnd.choice(("", "facile", "media", "dura")),
+            "fatto": done,
+        })
+    monthly = day.day <= 7 and rnd.random() < 0.5
+    misure = {k: "" for k in ("petto", "vita", "fianchi", "coscia", "braccio")}
+    if monthly:
+        misure.update(petto=str(rnd.randint(88, 100)), vita=str(rnd.randint(70, 85)),
+                      fianchi=str(rnd.randint(88, 100)), coscia=str(rnd.randint(50, 60)),
+                      braccio=str(rnd.randint(28, 34)))
+    app.normalize_session({"ex": ex})
+    done_count = sum(1 for e in ex if e["fatto"])
+    return {
+        "data": day.isoformat(), "giorno": wd, "ex": ex,
+        "preworkout": rnd.random() < 0.5, "proteine_post": rnd.random() < 0.7, "creatina_post": rnd.random() < 0.3,
+        "q_preworkout_pill": rnd.choice(("", "1")), "q_proteine_post_g": rnd.choice(("", "25", "30")),
+        "q_creatina_post_g": rnd.choice(("", "3", "5")),
+        "misure": misure,
+        "foto": f"/user_uploads/bench/{day.isoformat()}_foto.jpg" if monthly and rnd.random() < 0.5 else "",
+        "completion": int(100 * done_count / len(ex)) if ex else 0,
+    }
+
+def _meals(rnd, app, day, plan_type):
+    plan = app.DEFAULT_MEAL_PLAN[plan_type]
+    m = {"data": day.isoformat(), "plan_type": plan_type, "kcal_target": plan["kcal_target"], "meals": [],
+         "creatina_mattino": rnd.random() < 0.5, "termogenico_mattino": rnd.random() < 0.3,
+         "proteine_pasto": rnd.random() < 0.4, "q_creatina_mattino_g": rnd.choice(("", "3", "5")),
+         "q_termogenico_mattino_pill": rnd.choice(("", "1")), "q_proteine_pasto_g": rnd.choice(("", "25")),
+         "note": "", "completion": 0}
+    tot = [0.0, 0.0, 0.0, 0.0]; consumed_count = 0
+    for meal in plan["meals"]:
+        consumed = rnd.random() < 0.85
+        qty = round(meal["planned_qty"] * rnd.uniform(0.8, 1.2), 0) if meal["unit"] == "g" else meal["planned_qty"]
+        factor = qty / meal["base"]
+        vals = [round(factor * meal[k], 1) for k in ("kcal_base", "prot_base", "carb_base", "fat_base")]
+        if consumed:
+            consumed_count += 1
+            tot = [a + b for a, b in zip(tot, vals)]
+        m["meals"].append({
+            "key": meal["key"], "label": meal["label"], "planned_qty": meal["planned_qty"], "unit": meal["unit"],
+            "consumed": consumed, "consumed_qty": qty, "base": meal["base"],
+            "kcal_base": meal["kcal_base"], "prot_base": meal["prot_base"],
+            "carb_base": meal["carb_base"], "fat_base": meal["fat_base"],
+            "meal_kcal": vals[0], "meal_prot": vals[1], "meal_carb": vals[2], "meal_fat": vals[3],
+        })
+    m["completion"] = int(100 * consumed_count / len(plan["meals"]))
+    m["kcal"] = round(tot[0], 0)
+    m["proteine_g"], m["carbo_g"], m["grassi_g"] = (round(v, 1) for v in tot[1:])
+    return m
+
+def generate_user(years=1, sessions_per_week=4, seed=0, end=None):
+    """Documento completo di un utente con `years` anni di storico fino a `end` (oggi)."""
+    import app
+    rnd = random.Random(seed)
+    end = end or datetime.date.today()
+    start = end - datetime.timedelta(days=int(365 * years))
+    train_days = _training_days(sessions_per_week, app.WORKOUT_PLAN)
+
+    data = app.default_data()
+    data["meal_plan"] = {wd: ("training" if wd in train_days else "rest") for wd in WEEKDAYS}
+    data["goals"].update(weight_start=78.0, weight_target=70.0)
+    weight = 78.0; loads = {}
+    day = start
+    while day <= end:
+        wd = day.strftime("%A")
+        weight += rnd.uniform(-0.12, 0.09)
+        diary = {"data": day.isoformat(),
+                 "creatina": False, "preworkout": False, "termogenico": False, "proteine": False,
+                 "q_creatina_g": rnd.choice(("", "3", "5")), "q_preworkout_pill": "",
+                 "q_termogenico_pill": rnd.choice(("", "", "1")), "q_proteine_g": rnd.choice(("", "25", "50")),
+                 "peso": str(round(weight, 1)) if rnd.random() < 0.4 else "",
+                 "vita": str(rnd.randint(72, 84)) if day.weekday() == 0 else "",
+                 "fianchi": str(rnd.randint(90, 98)) if day.weekday() == 0 else "",
+                 "note": ""}
+        if wd in train_days and rnd.random() < 0.9:
+            s = _session(rnd, app, day, wd, loads)
+            data["allenamenti"].append(s)
+            diary["preworkout"] = s["preworkout"]
+            diary["q_preworkout_pill"] = s["q_preworkout_pill"] if s["preworkout"] else ""
+        if rnd.random() < 0.9:
+            data["giornaliero"].append(diary)
+        if rnd.random() < 0.8:
+            data["alimentazione"].append(_meals(rnd, app, day, data["meal_plan"][wd]))
+        day += datetime.timedelta(days=1)
+    data[app.TRAINING_ROLLUP] = app.build_training_rollup(data["allenamenti"])
+    return data
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--out", required=True, help="DATA_ROOT di destinazione")
+    ap.add_argument("--users", type=int, default=1)
+    ap.add_argument("--years", type=float, default=1.0)
+    ap.add_argument("--sessions-per-week", type=int, default=4)
+    ap.add_argument("--prefix", default="bench")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    # DATA_ROOT va fissata prima di importare l'app
+    os.environ["DATA_ROOT"] = args.out
+    import app
+    for i in range(args.users):
+        uid = f"{args.prefix}{i}"
+        data = generate_user(args.years, args.sessions_per_week, seed=args.seed + i)
+        app.save_data(data, uid)
+        print(f"{uid}: {len(data['giornaliero'])} giorni, {len(data['allenamenti'])} sessioni")
+
+if __name__ == "__main__":
+    main()
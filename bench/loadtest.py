@@ -0,0 +1,394 @@
+"""Load test HTTP con traffico realistico di più utenti contro un'app avviata in locale.
+
+    python bench/loadtest.py                                   # gunicorn come nel Procfile, 20 utenti
+    python bench/loadtest.py --users 50 --concurrency 16 --duration 60 --think-ms 500
+    python bench/loadtest.py --workers 4 --threads 8 --json bench/load.json
+    python bench/loadtest.py --url http://127.0.0.1:5000       # server già avviato
+
+Senza --url genera `--users` utenti (bench/gendata.py) in una DATA_ROOT temporanea e avvia
+gunicorn con --workers/--threads (o `flask run` con --server flask); STORAGE_BACKEND,
+WRITE_BEHIND ecc. passano al server come variabili d'ambiente. Ogni thread simula utenti
+(cookie `u`) che percorrono i flussi dell'app con un tempo di riflessione esponenziale;
+alla fine stampa throughput, latenze p50/p95/p99 per route, errori e i controlli di
+integrità sui dati scritti (export prima/dopo). Exit 1 se ci sono errori o incongruenze.
+"""
+import argparse, datetime, http.client, json, math, os, random, signal, socket, subprocess, sys, \
+    tempfile, threading, time
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+# peso relativo di ogni flusso (un utente apre il diario molto più spesso di quanto esporti)
+FLOWS = (("diario", 40), ("allenamento", 20), ("alimentazione", 20), ("progressi", 15), ("export", 5))
+SERIES = ("peso", "vita", "ex_done", "volume")
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+class Stats:
+    """Latenze ed errori per route, condivisi fra i thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.samples = {}
+
+    def add(self, route, ms, error=None):
+        with self.lock:
+            self.times[route].append(ms)
+            if error:
+                self.errors[route] += 1
+                self.samples.setdefault(route, error)
+
+    def report(self, elapsed):
+        rows = {}
+        for route in sorted(self.times):
+            t = self.times[route]
+            rows[route] = {"n": len(t), "errors": self.errors[route], "rps": round(len(t) / elapsed, 2),
+                           "p50_ms": round(percentile(t, 50), 2), "p95_ms": round(percentile(t, 95), 2),
+                           "p99_ms": round(percentile(t, 99), 2), "max_ms": round(max(t), 2)}
+        total = sum(r["n"] for r in rows.values())
+        errors = sum(r["errors"] for r in rows.values())
+        return {"elapsed_s": round(elapsed, 2), "requests": total, "errors": errors,
+                "rps": round(total / elapsed, 2) if elapsed else 0.0,
+                "error_rate": round(errors / total, 4) if total else 0.0, "routes": rows}
+
+class Ledger:
+    """Scritture andate a buon fine per utente, da confrontare con l'export finale."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = defaultdict(int)
+        self.meal_days = defaultdict(set)
+        self.creatina = defaultdict(float)
+        self.uncertain = set()  # POST senza risposta: l'esito sul server non è noto
+
+    def session(self, uid, creatina):
+        with self.lock:
+            self.sessions[uid] += 1
+            self.creatina[uid] += creatina
+
+    def meals(self, uid, day, creatina):
+        with self.lock:
+            self.meal_days[uid].add(day)
+            self.creatina[uid] += creatina
+
+    def lost(self, uid):
+        with self.lock:
+            self.uncertain.add(uid)
+
+class Client:
+    """Un "browser": connessione keep-alive, cookie u= ed ETag per le GET ripetute."""
+    def __init__(self, base, stats, timeout):
+        parts = urlsplit(base)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.stats, self.timeout = stats, timeout
+        self.conn = None
+        self.etags = {}
+
+    def request(self, route, method, path, uid, form=None):
+        headers = {"Cookie": f"u={uid}"}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif (uid, path) in self.etags:
+            headers["If-None-Match"] = self.etags[(uid, path)]
+        t0 = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            self.stats.add(route, (time.perf_counter() - t0) * 1000, f"{type(e).__name__}: {e}")
+            return None
+        ms = (time.perf_counter() - t0) * 1000
+        # le POST rispondono con un redirect, che il browser seguirebbe come GET a parte
+        ok = resp.status in ((302, 303) if form is not None else (200, 304))
+        self.stats.add(route, ms, None if ok else f"HTTP {resp.status} {method} {path}")
+        if ok and resp.getheader("ETag"):
+            self.etags[(uid, path)] = resp.getheader("ETag")
+        if resp.getheader("Connection", "").lower() == "close":
+            self.close()
+        return resp.status if ok else None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def _pick_day(rnd, today):
+    # quasi sempre oggi, a volte un giorno recente da correggere
+    return today if rnd.random() < 0.7 else today - datetime.timedelta(days=rnd.randint(1, 14))
+
+def flow_diario(c, rnd, uid, day, ledger, app):
+    q = f"date={day.isoformat()}"
+    c.request("GET /diario", "GET", f"/diario?{q}", uid)
+    for scope in rnd.sample(("weekly", "monthly"), rnd.randint(0, 2)):
+        c.request(f"GET /diario {scope}", "GET", f"/diario?{q}&scope={scope}", uid)
+
+def flow_allenamento(c, rnd, uid, day, ledger, app):
+    path = f"/allenamenti?date={day.isoformat()}"
+    c.request("GET /allenamenti", "GET", path, uid)
+    form = {}
+    for idx, ex in enumerate(app.WORKOUT_PLAN.get(day.strftime("%A"), [])):
+        if rnd.random() < 0.8:
+            load = rnd.choice((20, 30, 40, 50))
+            form.update({f"plan_{idx}_use": "1", f"plan_{idx}_carico": str(load),
+                         f"plan_{idx}_setdet": f"10@{load}, 8@{load + 2.5}",
+                         f"plan_{idx}_diff": rnd.choice(("", "media", "dura"))})
+            if rnd.random() < 0.85:
+                form[f"plan_{idx}_done"] = "1"
+    lib = list(app.EXERCISE_LIBRARY.values())
+    for _ in range(rnd.randint(0, 2)):
+        cat = rnd.randrange(len(lib))
+        i = rnd.randrange(len(lib[cat]))
+        form.update({f"lib_{cat}_{i}_use": "1", f"lib_{cat}_{i}_done": "1", f"lib_{cat}_{i}_serie": "3",
+                     f"lib_{cat}_{i}_ripetizioni": "12", f"lib_{cat}_{i}_carico": str(rnd.choice((10, 15, 20)))})
+    if rnd.random() < 0.3:
+        form.update({"cust_0_name": "Plank", "cust_0_serie": "3", "cust_0_ripetizioni": "60s", "cust_0_done": "1"})
+    creatina = 0.0
+    if rnd.random() < 0.4:
+        creatina = float(rnd.choice((3, 5)))
+        form.update({"creatina_post": "1", "q_creatina_post_g": f"{creatina:g}"})
+    if rnd.random() < 0.5:
+        form.update({"proteine_post": "1", "q_proteine_post_g": "30"})
+    if c.request("POST /allenamenti", "POST", path, uid, form):
+        ledger.session(uid, creatina)
+    else:
+        ledger.lost(uid)
+
+def flow_alimentazione(c, rnd, uid, day, ledger, app):
+    path = f"/alimentazione?date={day.isoformat()}"
+    c.request("GET /alimentazione", "GET", path, uid)
+    form = {}
+    plan = app.DEFAULT_MEAL_PLAN["training" if day.strftime("%A") in app.WORKOUT_PLAN else "rest"]
+    for meal in plan["meals"]:
+        key = meal["key"]
+        # la pagina rimanda anche i valori base del pasto come campi nascosti
+        form.update({f"meal_{key}_{k}": str(meal[k]) for k in ("base", "kcal_base", "prot_base", "carb_base", "fat_base")})
+        form[f"meal_{key}_qty"] = str(meal["planned_qty"] if meal["unit"] != "g"
+                                      else round(meal["planned_qty"] * rnd.uniform(0.8, 1.2)))
+        if rnd.random() < 0.85:
+            form[f"meal_{key}_done"] = "1"
+    creatina = 0.0
+    if rnd.random() < 0.5:
+        creatina = float(rnd.choice((3, 5)))
+        form.update({"creatina_mattino": "1", "q_creatina_mattino_g": f"{creatina:g}"})
+    if c.request("POST /alimentazione", "POST", path, uid, form):
+        ledger.meals(uid, day.isoformat(), creatina)
+    else:
+        ledger.lost(uid)
+
+def flow_progressi(c, rnd, uid, day, ledger, app):
+    c.request("GET /progressi", "GET", "/progressi", uid)
+    days = rnd.choice((None, 30, 90, 365))
+    q = {"points": 400}
+    if days:
+        q["from"] = (day - datetime.timedelta(days=days)).isoformat()
+    for metric in SERIES:
+        c.request("GET /api/series", "GET", f"/api/series/{metric}?{urlencode(q)}", uid)
+
+def flow_export(c, rnd, uid, day, ledger, app):
+    c.request("GET /export", "GET", "/export", uid)
+
+def virtual_users(base, uids, stats, ledger, deadline, think_ms, seed, timeout):
+    import app
+    flows = [globals()[f"flow_{name}"] for name, _ in FLOWS]
+    weights = [w for _, w in FLOWS]
+    rnd = random.Random(seed)
+    c = Client(base, stats, timeout)
+    today = datetime.date.today()
+    while time.monotonic() < deadline:
+        uid = rnd.choice(uids)
+        rnd.choices(flows, weights)[0](c, rnd, uid, _pick_day(rnd, today), ledger, app)
+        if think_ms:
+            time.sleep(min(rnd.expovariate(1000 / think_ms), max(0.0, deadline - time.monotonic())))
+    c.close()
+
+def snapshot(base, uid, timeout):
+    """Conteggi dall'export JSON di un utente (None se l'export fallisce)."""
+    parts = urlsplit(base)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        conn.request("GET", "/export?" + urlencode([("u", uid), ("collection", "allenamenti"),
+                                                    ("collection", "alimentazione"), ("collection", "giornaliero")]))
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            return None
+        data = json.loads(body)
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+    finally:
+        conn.close()
+    import app
+    diary_days = [d["data"] for d in data.get("giornaliero", [])]
+    meal_days = [m["data"] for m in data.get("alimentazione", [])]
+    return {"sessions": len(data.get("allenamenti", [])), "meal_days": set(meal_days),
+            "dup_days": len(diary_days) - len(set(diary_days)) + len(meal_days) - len(set(meal_days)),
+            "creatina": sum(app.sum_float(d.get("q_creatina_g")) for d in data.get("giornaliero", []))}
+
+def check_integrity(base, uids, before, ledger, timeout):
+    """Confronta l'export finale con le scritture confermate; ritorna la lista dei problemi."""
+    problems = []
+    for uid in uids:
+        after = snapshot(base, uid, timeout)
+        if before.get(uid) is None or after is None:
+            problems.append(f"{uid}: export non riuscito")
+            continue
+        if after["dup_days"]:
+            problems.append(f"{uid}: {after['dup_days']} giorni duplicati in giornaliero/alimentazione")
+        missing = ledger.meal_days[uid] - after["meal_days"]
+        if missing:
+            problems.append(f"{uid}: alimentazione mancante per {sorted(missing)}")
+        if uid in ledger.uncertain:
+            continue  # conteggi esatti solo se ogni POST ha avuto risposta
+        got = after["sessions"] - before[uid]["sessions"]
+        if got != ledger.sessions[uid]:
+            problems.append(f"{uid}: {got} sessioni nuove, attese {ledger.sessions[uid]}")
+        delta = after["creatina"] - before[uid]["creatina"]
+        if abs(delta - ledger.creatina[uid]) > 1e-6:
+            problems.append(f"{uid}: creatina +{delta:g} g nel diario, attesi +{ledger.creatina[uid]:g} g")
+    return problems
+
+def seed_users(n, years, sessions_per_week, prefix):
+    import app
+    from gendata import generate_user
+    uids = [f"{prefix}{i}" for i in range(n)]
+    for i, uid in enumerate(uids):
+        app.save_data(generate_user(years, sessions_per_week, seed=i), uid)
+    app.flush_pending()
+    return uids
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(kind, port, workers, threads, data_root):
+    env = dict(os.environ, DATA_ROOT=data_root)
+    if kind == "gunicorn":
+        # stessa riga di comando del Procfile
+        cmd = [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+               "--workers", str(workers), "--threads", str(threads)]
+    else:
+        cmd = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+    proc = subprocess.Popen(cmd, cwd=REPO_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"il server è terminato all'avvio (exit {proc.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    stop_server(proc)
+    sys.exit("il server non risponde dopo 30 s")
+
+def stop_server(proc):
+    # SIGTERM: gunicorn chiude i worker con worker_exit, che svuota il write-behind
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def print_report(res, problems, checked):
+    print(f"\n{res['requests']} richieste in {res['elapsed_s']:g} s: {res['rps']:g} req/s, "
+          f"{res['errors']} errori ({100 * res['error_rate']:.2f}%)\n")
+    print(f"  {'route':<24} {'n':>7} {'err':>5} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for route, r in res["routes"].items():
+        print(f"  {route:<24} {r['n']:>7} {r['errors']:>5} {r['rps']:>8.2f} {r['p50_ms']:>9.2f} "
+              f"{r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['max_ms']:>9.2f}")
+    for route, sample in res.get("error_samples", {}).items():
+        print(f"  errore {route}: {sample}")
+    print()
+    for p in problems:
+        print(f"INTEGRITÀ {p}")
+    if not problems:
+        print(f"integrità ok su {checked} utenti")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--url", help="server già avviato (niente generazione di utenti né avvio)")
+    ap.add_argument("--server", choices=("gunicorn", "flask"), default="gunicorn")
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 2)))
+    ap.add_argument("--threads", type=int, default=int(os.environ.get("GUNICORN_THREADS", 4)))
+    ap.add_argument("--data-root", help="DATA_ROOT del server avviato (default: cartella temporanea)")
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--user-prefix", default="load")
+    ap.add_argument("--years", type=float, default=0.5, help="storico generato per ogni utente")
+    ap.add_argument("--sessions-per-week", type=int, default=4)
+    ap.add_argument("--concurrency", type=int, default=8, help="client simultanei")
+    ap.add_argument("--duration", type=float, default=30.0, help="secondi di traffico")
+    ap.add_argument("--think-ms", type=float, default=200.0, help="pausa media fra due richieste (0 = nessuna)")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", metavar="PATH", help="salva il report in JSON")
+    args = ap.parse_args(argv)
+
+    uids = [f"{args.user_prefix}{i}" for i in range(args.users)]
+    proc = None
+    if args.url:
+        base = args.url.rstrip("/")
+        # l'app serve solo per piano e libreria: non deve creare users/ nella cartella corrente
+        os.environ.setdefault("DATA_ROOT", tempfile.mkdtemp(prefix="fitness-load-"))
+    else:
+        # DATA_ROOT va fissata prima di importare l'app
+        os.environ["DATA_ROOT"] = args.data_root or tempfile.mkdtemp(prefix="fitness-load-")
+        print(f"genero {args.users} utenti ({args.years:g} anni) in {os.environ['DATA_ROOT']}")
+        seed_users(args.users, args.years, args.sessions_per_week, args.user_prefix)
+        port = _free_port()
+        proc = start_server(args.server, port, args.workers, args.threads, os.environ["DATA_ROOT"])
+        base = f"http://127.0.0.1:{port}"
+
+    try:
+        before = {uid: snapshot(base, uid, args.timeout) for uid in uids}
+        stats, ledger = Stats(), Ledger()
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=virtual_users, daemon=True,
+                                    args=(base, uids, stats, ledger, deadline, args.think_ms,
+                                          args.seed * 1000 + i, args.timeout))
+                   for i in range(args.concurrency)]
+        print(f"{args.concurrency} client su {base} per {args.duration:g} s (think {args.think_ms:g} ms)")
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        res = stats.report(time.perf_counter() - t0)
+        res["error_samples"] = dict(stats.samples)
+        problems = check_integrity(base, uids, before, ledger, args.timeout)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    print_report(res, problems, len(uids))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "url": args.url, "server": None if args.url else args.server,
+                       "workers": args.workers, "threads": args.threads, "users": args.users,
+                       "concurrency": args.concurrency, "think_ms": args.think_ms,
+                       "backend": os.environ.get("STORAGE_BACKEND", "json"),
+                       "write_behind": os.environ.get("WRITE_BEHIND", ""),
+                       "integrity": problems, **res}, f, indent=2)
+        print(f"report salvato in {args.json}")
+    if res["errors"] or problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
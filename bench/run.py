@@ -0,0 +1,145 @@
+"""Microbenchmark di helper e route al crescere dello storico.
+
+    python bench/run.py                              # taglie 0.25, 1, 3 anni
+    python bench/run.py --years 1,5 --save bench/baseline.json
+    python bench/run.py --compare bench/baseline.json  # exit 1 se qualcosa peggiora
+
+Per ogni taglia genera un utente (bench/gendata.py) in una DATA_ROOT temporanea e
+misura ogni caso `--repeat` volte; si confronta la mediana. STORAGE_BACKEND e
+DOC_CACHE_BYTES si scelgono come per l'app, via variabili d'ambiente.
+"""
+import argparse, datetime, json, os, platform, statistics, sys, tempfile, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+def measure(fn, repeat):
+    fn()  # riscaldamento (cache, template compilati)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return {"median_ms": round(statistics.median(times), 3), "min_ms": round(min(times), 3)}
+
+def _last_weekday(day, name):
+    while day.strftime("%A") != name:
+        day -= datetime.timedelta(days=1)
+    return day
+
+def cases(app, client, uid, data):
+    """(nome, funzione) per ogni helper e route misurati."""
+    ref = datetime.date.today()
+    sessions = data["allenamenti"]
+    set_details = [e["set_dettagli"] for s in sessions for e in s["ex"] if e.get("set_dettagli")]
+    train_day = _last_weekday(ref, "Monday").isoformat()
+
+    def load_cold():
+        if getattr(app.STORE, "cache", None) is not None:
+            app.STORE.cache.drop(uid)
+        app.load_data(uid)
+
+    def get(path):
+        def run():
+            r = client.get(path)
+            assert r.status_code == 200, (path, r.status_code)
+        return run
+
+    def post(path, form):
+        def run():
+            r = client.post(path, data=form)
+            assert r.status_code == 302, (path, r.status_code)
+        return run
+
+    plan_form = {"plan_0_use": "1", "plan_0_done": "1", "plan_0_carico": "40", "plan_0_setdet": "10@40, 8@45",
+                 "plan_1_use": "1", "plan_1_carico": "30"}
+    meal_form = {"meal_colazione_done": "1", "meal_colazione_qty": "300", "meal_colazione_kcal_base": "110",
+                 "meal_pranzo_done": "1", "meal_pranzo_qty": "350", "meal_pranzo_kcal_base": "160"}
+    q = f"u={uid}&date={ref.isoformat()}"
+    return [
+        ("integratori_aggregate", lambda: app.integratori_aggregate(data, ref, "monthly")),
+        ("compute_training_stats", lambda: app.compute_training_stats(sessions)),
+        ("split_sets", lambda: [app.split_sets(s) for s in set_details]),
+        ("load_data", lambda: app.load_data(uid)),
+        ("load_data_cold", load_cold),
+        ("save_data", lambda: app.save_data(app.load_data(uid), uid)),
+        ("GET /diario daily", get(f"/diario?{q}")),
+        ("GET /diario monthly", get(f"/diario?{q}&scope=monthly")),
+        ("GET /progressi", get(f"/progressi?u={uid}")),
+        ("GET /api/series/peso", get(f"/api/series/peso?u={uid}")),
+        ("GET /api/series/volume", get(f"/api/series/volume?u={uid}")),
+        ("GET /allenamenti", get(f"/allenamenti?u={uid}&date={train_day}")),
+        ("POST /allenamenti", post(f"/allenamenti?u={uid}&date={train_day}", plan_form)),
+        ("GET /alimentazione", get(f"/alimentazione?{q}")),
+        ("POST /alimentazione", post(f"/alimentazione?{q}", meal_form)),
+    ]
+
+def run(sizes, repeat, sessions_per_week):
+    import app
+    from gendata import generate_user
+    client = app.app.test_client()
+    results = {}
+    for years in sizes:
+        uid = f"bench_{years:g}y"
+        data = generate_user(years, sessions_per_week, seed=int(years * 100))
+        app.save_data(data, uid)
+        app.flush_pending()  # con WRITE_BEHIND=1 il file non c'è ancora
+        size_kb = os.path.getsize(app.user_dirs(uid)[0]) // 1024 if app.STORAGE_BACKEND == "json" else None
+        print(f"\n== {years:g} anni: {len(data['giornaliero'])} giorni, {len(data['allenamenti'])} sessioni"
+              + (f", {size_kb} KB" if size_kb is not None else ""))
+        for name, fn in cases(app, client, uid, data):
+            res = measure(fn, repeat)
+            results[f"{years:g}y {name}"] = res
+            print(f"  {name:<28} {res['median_ms']:>10.3f} ms  (min {res['min_ms']:.3f})")
+    return results
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """Casi con mediana oltre threshold × baseline (e almeno min_delta_ms in più)."""
+    regressions = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        old, new = base["median_ms"], res["median_ms"]
+        if new > old * threshold and new - old >= min_delta_ms:
+            regressions.append((key, old, new))
+    return regressions
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--years", default="0.25,1,3", help="taglie dello storico, separate da virgola")
+    ap.add_argument("--sessions-per-week", type=int, default=4)
+    ap.add_argument("--repeat", type=int, default=7)
+    ap.add_argument("--data-root", help="DATA_ROOT da usare (default: cartella temporanea)")
+    ap.add_argument("--save", metavar="PATH", help="salva i risultati come baseline")
+    ap.add_argument("--compare", metavar="PATH", help="confronta con una baseline salvata")
+    ap.add_argument("--threshold", type=float, default=1.25, help="rapporto oltre cui è una regressione")
+    ap.add_argument("--min-delta-ms", type=float, default=0.5, help="differenze più piccole sono rumore")
+    args = ap.parse_args(argv)
+
+    # DATA_ROOT va fissata prima di importare l'app
+    os.environ["DATA_ROOT"] = args.data_root or tempfile.mkdtemp(prefix="fitness-bench-")
+    sizes = [float(y) for y in args.years.split(",") if y.strip()]
+    results = run(sizes, args.repeat, args.sessions_per_week)
+
+    if args.save:
+        import app
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "backend": app.STORAGE_BACKEND,
+                       "repeat": args.repeat, "results": results}, f, indent=2)
+        print(f"\nbaseline salvata in {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        print()
+        for key, old, new in regressions:
+            print(f"REGRESSIONE {key}: {old:.3f} -> {new:.3f} ms (x{new / old:.2f})")
+        if regressions:
+            sys.exit(1)
+        print(f"nessuna regressione oltre x{args.threshold:g} rispetto a {args.compare}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# Letto in automatico da gunicorn (./gunicorn.conf.py).
+import os
+
+def worker_exit(server, worker):
+    # write-behind: le modifiche ancora in memoria vanno su disco prima che il worker termini
+    from app import flush_pending
+    flush_pending()
+
+def _single_worker(server):
+    # write-behind: i salvataggi in attesa stanno nella memoria di un solo processo; con più
+    # worker la GET dopo un POST può finire su un altro e vedere dati vecchi fino al flush
+    if os.environ.get("WRITE_BEHIND") == "1" and server.num_workers > 1:
+        server.log.warning("WRITE_BEHIND=1: avvio 1 worker invece di %s", server.num_workers)
+        server.num_workers = 1
+
+on_starting = on_reload = _single_worker